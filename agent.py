@@ -0,0 +1,338 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2009-2010 Juan David Ibáñez Palomar <jdavid@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from getpass import getpass
+from json import dumps, loads
+from os import chmod, makedirs, remove, umask
+from os.path import dirname, exists, expanduser
+from SocketServer import StreamRequestHandler, ThreadingUnixStreamServer
+import socket
+import sys
+from threading import Lock, Thread, local
+from time import sleep, time
+
+# Import from usine
+import hosts
+from tracing import span
+
+
+"""
+The agent keeps the SSH connections open between invocations of usine.py.
+
+It is started with 'usine.py --agent', and listens on a Unix socket.  While
+it runs, usine.py sends the remote operations (run, put, ...) to the agent
+(see AgentHost), which executes them through its own, already authenticated,
+connections, and streams back their output.
+
+The protocol is made of JSON lines.  The client sends one request:
+
+  {"host": .., "user": .., "shell": .., "method": .., "args": [..]}
+
+The agent answers with any number of {"out": ..} messages, for the output
+to print, and ends with either {"result": ..} or {"error": .., "args": ..}.
+Strings are decoded as latin-1, so arbitrary bytes go through.
+"""
+
+
+def get_socket_path():
+    return expanduser('~/.usine/var/agent.sock')
+
+
+# The methods of RemoteHost the agent may call
+methods = frozenset(['run', 'run_python', 'get_checksums', 'put',
+                     'put_many'])
+
+# The exceptions sent back as they are, others become RuntimeError
+errors = {
+    'EnvironmentError': EnvironmentError,
+    'IOError': IOError,
+    'OSError': OSError,
+    'ValueError': ValueError}
+
+
+
+def encode(value):
+    if type(value) is str:
+        return value.decode('latin-1')
+    return value
+
+
+
+def decode(value):
+    if type(value) is unicode:
+        return value.encode('latin-1')
+    return value
+
+
+
+###########################################################################
+# Agent (server)
+###########################################################################
+class Output(object):
+    """Replaces sys.stdout in the agent, to send what is printed while
+    serving a request to its client.
+    """
+
+    def __init__(self, default):
+        self.default = default
+        self.local = local()
+
+
+    def write(self, data):
+        handler = getattr(self.local, 'handler', None)
+        if handler is None:
+            self.default.write(data)
+        else:
+            handler.send({'out': encode(data)})
+
+
+    def flush(self):
+        if getattr(self.local, 'handler', None) is None:
+            self.default.flush()
+
+
+
+class PassphraseRequired(Exception):
+    pass
+
+
+def no_passphrase():
+    # The agent has no terminal to ask for it, the client does
+    raise PassphraseRequired
+
+
+
+class AgentHandler(StreamRequestHandler):
+
+    def send(self, message):
+        self.wfile.write(dumps(message) + '\n')
+        self.wfile.flush()
+
+
+    def handle(self):
+        server = self.server
+        server.last_request = time()
+        line = self.rfile.readline()
+        if not line:
+            # See is_running
+            return
+        request = loads(line)
+        sys.stdout.local.handler = self
+        server.add_running(1)
+        try:
+            if request.get('passphrase'):
+                hosts.passphrase = decode(request['passphrase'])
+            method = request['method']
+            if method not in methods:
+                raise ValueError, 'unexpected method "%s"' % method
+            host = hosts.get_remote_host(request['host'], request['user'],
+                                         request['shell'])
+            args = [ decode(x) for x in request['args'] ]
+            result = getattr(host, method)(*args)
+        except PassphraseRequired:
+            self.send({'error': 'PassphraseRequired', 'args': []})
+        except Exception, error:
+            name = type(error).__name__
+            if name not in errors:
+                name, error.args = 'RuntimeError', (str(error),)
+            args = [ encode(x) for x in error.args ]
+            self.send({'error': name, 'args': args})
+        else:
+            self.send({'result': encode(result)})
+        finally:
+            sys.stdout.local.handler = None
+            server.add_running(-1)
+
+
+
+class AgentServer(ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    # The number of requests being served, the agent is not idle meanwhile
+    running = 0
+    running_lock = Lock()
+
+    def add_running(self, n):
+        with self.running_lock:
+            self.running += n
+            self.last_request = time()
+
+
+    def is_idle(self, timeout):
+        with self.running_lock:
+            if self.running:
+                return False
+            return time() - self.last_request >= timeout
+
+
+
+def serve(timeout=1800):
+    """Runs the agent until interrupted, or until it has been idle for the
+    given number of seconds: no request served meanwhile, however long a
+    request takes.
+    """
+    path = get_socket_path()
+    if is_running():
+        print 'Error: the agent is already running (%s)' % path
+        return
+    # Only this user may use the connections: the socket is created with
+    # no access for others, there is no window before the chmod
+    folder = dirname(path)
+    if not exists(folder):
+        makedirs(folder, 0700)
+    if exists(path):
+        remove(path)
+
+    sys.stdout = Output(sys.stdout)
+    hosts.ask_passphrase = no_passphrase
+    hosts.use_agent = False
+    old_umask = umask(077)
+    try:
+        server = AgentServer(path, AgentHandler)
+    finally:
+        umask(old_umask)
+    chmod(path, 0600)
+    server.last_request = time()
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print 'Agent listening on %s' % path
+    try:
+        while not server.is_idle(timeout):
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        remove(path)
+        for host in hosts.remote_hosts.values():
+            host.close()
+    print 'Agent stopped'
+
+
+
+###########################################################################
+# Client
+###########################################################################
+def connect():
+    """Returns a socket connected to the agent, or None if it is not
+    running.
+    """
+    path = get_socket_path()
+    if not exists(path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error:
+        client.close()
+        return None
+    return client
+
+
+
+def is_running():
+    client = connect()
+    if client is None:
+        return False
+    client.close()
+    return True
+
+
+
+class AgentHost(object):
+    """Same interface as RemoteHost, the operations are sent to the agent.
+    """
+
+    def __init__(self, host, user, shell):
+        self.key = host
+        self.host = host.split(':')[0]
+        self.user = user
+        self.shell = shell
+        self.cwd = None
+
+
+    def chdir(self, cwd):
+        self.cwd = cwd
+
+
+    def close(self):
+        # The agent keeps the connection open
+        pass
+
+
+    def call(self, method, *args):
+        request = {'host': self.key, 'user': self.user, 'shell': self.shell,
+                   'method': method, 'args': [ encode(x) for x in args ]}
+        # The agent does not trace, the whole call is recorded here
+        with span(method, 'host', host=self.host, agent=True):
+            return self._call(request)
+
+
+    def _call(self, request):
+        while True:
+            client = connect()
+            if client is None:
+                raise EnvironmentError, (None, 'the agent is not running')
+            try:
+                client.sendall(dumps(request) + '\n')
+                file = client.makefile('rb')
+                for line in file:
+                    message = loads(line)
+                    if 'out' in message:
+                        hosts.write_output(decode(message['out']))
+                    elif 'result' in message:
+                        return decode(message['result'])
+                    elif message['error'] == 'PassphraseRequired':
+                        request['passphrase'] = getpass(
+                            'Enter passphrase for key: ')
+                        break
+                    else:
+                        error = errors.get(message['error'], RuntimeError)
+                        args = [ decode(x) for x in message['args'] ]
+                        raise error(*args)
+                else:
+                    raise EnvironmentError, (None, 'the agent went away')
+            finally:
+                client.close()
+
+
+    def run(self, command, cwd=None, quiet=False):
+        if cwd:
+            self.cwd = cwd
+        return self.call('run', command, cwd or self.cwd, quiet)
+
+
+    def run_python(self, bin_python, script, data, cwd=None):
+        if cwd:
+            self.cwd = cwd
+        return self.call('run_python', bin_python, script, data,
+                         cwd or self.cwd)
+
+
+    def get_checksums(self, folder, names):
+        return self.call('get_checksums', folder, names)
+
+
+    def put(self, source, target):
+        # The agent runs on this host, so it reads the source file itself
+        return self.call('put', source, target)
+
+
+    def put_many(self, sources, target):
+        return self.call('put_many', sources, target)
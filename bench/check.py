@@ -0,0 +1,164 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2009-2010 Juan David Ibáñez Palomar <jdavid@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+import sys
+from threading import Thread
+from time import sleep, time
+
+
+"""
+Checks the health checks (see the probes module, and 'pyenv test') against
+a local HTTP server standing in for ikaaro instances:
+
+- /ok answers its control page with 200, after the given delay
+- /error answers with 500
+- /slow answers after the timeout of the probes
+- a closed port, and a malformed URI
+
+It verifies the report of every URI: the probes that succeeded and failed,
+and that the latency percentiles are consistent with the delay.  Exits with
+1 if the report is wrong.
+
+Usage: python bench/check.py [options], with libusine installed.
+"""
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        if self.path == '/ok/;_ctrl':
+            sleep(server.delay)
+            status = 200
+        elif self.path == '/slow/;_ctrl':
+            sleep(server.timeout + 1)
+            status = 200
+        else:
+            status = 500
+        body = 'ok' if status == 200 else 'error'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+
+class Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The probes of /slow give up before the answer
+        pass
+
+
+
+def start_server(delay, timeout):
+    server = Server(('127.0.0.1', 0), Handler)
+    server.delay = delay
+    server.timeout = timeout
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+
+def get_closed_port():
+    server = Server(('127.0.0.1', 0), Handler)
+    port = server.server_address[1]
+    server.server_close()
+    return port
+
+
+
+if __name__ == '__main__':
+    usage = 'python bench/check.py [options]'
+    parser = OptionParser(usage)
+    parser.add_option('--samples', type='int', default=10,
+        help='The number of probes per URI (default: 10).')
+    parser.add_option('--delay', type='float', default=0.05,
+        help='The seconds /ok takes to answer (default: 0.05).')
+    parser.add_option('--timeout', type='float', default=1,
+        help='The timeout of the probes, in seconds (default: 1).')
+    options, args = parser.parse_args()
+
+    # Import from usine
+    from libusine.probes import check
+
+    server = start_server(options.delay, options.timeout)
+    base = 'http://127.0.0.1:%s' % server.server_address[1]
+    uris = {
+        'ok': '%s/ok' % base,
+        'error': '%s/error' % base,
+        'slow': '%s/slow' % base,
+        'closed': 'http://127.0.0.1:%s/ok' % get_closed_port(),
+        'malformed': 'http://[::1/ok'}
+
+    samples = options.samples
+    t0 = time()
+    report = check(uris.values(), samples, options.timeout)
+    seconds = time() - t0
+    server.shutdown()
+
+    # Report
+    print '%-10s %5s %6s %8s %8s %8s %8s' % (
+        'uri', 'ok', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+    for name in sorted(uris):
+        probes = report[uris[name]]
+        latencies = [ '%8.1f' % probes[x] if probes[x] is not None
+                      else '       -' for x in ['p50', 'p90', 'p99', 'max'] ]
+        print '%-10s %5d %6d %s' % (name, probes['ok'], probes['errors'],
+                                    ' '.join(latencies))
+    print 'Checked in %.2f s' % seconds
+
+    # Verify
+    errors = []
+    def verify(name, condition, message):
+        if not condition:
+            errors.append('%s: %s' % (name, message))
+
+    probes = report[uris['ok']]
+    verify('ok', probes['ok'] == samples and probes['errors'] == 0,
+           'every probe should succeed')
+    delay = options.delay * 1000
+    verify('ok', delay <= probes['p50'] <= probes['p90'] <= probes['p99']
+           <= probes['max'], 'the percentiles should be >= %.1f ms and in '
+           'order' % delay)
+    for name in ['error', 'slow', 'closed', 'malformed']:
+        probes = report[uris[name]]
+        verify(name, probes['ok'] == 0 and probes['errors'] == samples,
+               'every probe should fail')
+        verify(name, probes['p50'] is None and probes['max'] is None,
+               'there should be no latency')
+    verify('malformed', 'error' in report[uris['malformed']],
+           'the error should be reported')
+
+    for error in errors:
+        print '[ERROR] %s' % error
+    if errors:
+        sys.exit(1)
+    print '[OK] the report is right'
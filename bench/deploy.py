@@ -0,0 +1,218 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2009-2010 Juan David Ibáñez Palomar <jdavid@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from glob import glob
+from json import dumps
+from optparse import OptionParser, Values
+import os
+from os.path import dirname, join, realpath
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+from shutil import rmtree
+from subprocess import PIPE, Popen
+import sys
+from tempfile import mkdtemp
+from time import sleep, time
+
+# Import from the benchmarks
+from fixtures import make_world
+from sshserver import get_stats
+
+
+"""
+Benchmarks the deploy of Python environments (see the pyenv module):
+build, upload, install, restart and reindex, over a synthetic world of N
+packages, M environments and K instances per environment (see fixtures.py).
+
+The remote host is a local SSH server (see sshserver.py), in its own
+process, so the CPU time of usine and of the "remote" side are measured
+apart.  For every phase it reports the wall time, the round-trips
+(commands and SFTP requests) and the bytes the server saw, and the CPU
+time of both sides.
+
+Every environment is on the same host, so they share /tmp: the packages
+are uploaded once, for the first environment.
+
+Usage: python bench/deploy.py [options], with libusine installed.
+"""
+
+
+phases = 'build,upload,install,restart,reindex'
+
+
+def get_cpu():
+    cpu = 0.0
+    for who in [RUSAGE_SELF, RUSAGE_CHILDREN]:
+        usage = getrusage(who)
+        cpu += usage.ru_utime + usage.ru_stime
+    return cpu
+
+
+
+def start_server(home, stats_path):
+    folder = dirname(realpath(__file__))
+    env = dict(os.environ, HOME=home)
+    command = [sys.executable, join(folder, 'sshserver.py'), stats_path]
+    server = Popen(command, stdout=PIPE, env=env)
+    port = int(server.stdout.readline())
+    # The stats socket
+    while not os.path.exists(stats_path):
+        sleep(0.01)
+    return server, port
+
+
+
+def measure(stats_path, function):
+    """Calls the function, returns what it cost.
+    """
+    stats = get_stats(stats_path)
+    cpu = get_cpu()
+    t0 = time()
+    function()
+    seconds = time() - t0
+    cpu = get_cpu() - cpu
+    new_stats = get_stats(stats_path)
+    return {
+        'wall': seconds,
+        'round_trips': (
+            new_stats['commands'] - stats['commands']
+            + new_stats['sftp_requests'] - stats['sftp_requests']),
+        'bytes': (new_stats['bytes_in'] - stats['bytes_in']
+                  + new_stats['bytes_out'] - stats['bytes_out']),
+        'cpu_local': cpu,
+        'cpu_remote': new_stats['cpu'] - stats['cpu']}
+
+
+
+def print_report(report):
+    print
+    print '%-3s %-22s %9s %11s %12s %10s %10s' % (
+        'run', 'phase', 'wall s', 'round-trips', 'bytes', 'cpu local',
+        'cpu remote')
+    for run, phase, cost in report:
+        print '%-3d %-22s %9.2f %11d %12d %10.2f %10.2f' % (
+            run, phase, cost['wall'], cost['round_trips'], cost['bytes'],
+            cost['cpu_local'], cost['cpu_remote'])
+
+
+
+if __name__ == '__main__':
+    usage = 'python bench/deploy.py [options]'
+    parser = OptionParser(usage)
+    parser.add_option('-n', '--packages', type='int', default=3,
+        help='The number of packages (default: 3).')
+    parser.add_option('-m', '--pyenvs', type='int', default=2,
+        help='The number of Python environments (default: 2).')
+    parser.add_option('-k', '--instances', type='int', default=2,
+        help='The number of ikaaro instances per environment (default: 2).')
+    parser.add_option('--size', type='int', default=64,
+        help='The size of every package, in KB (default: 64).')
+    parser.add_option('--start-delay', type='float', default=0.1,
+        help='The seconds icms-start.py takes (default: 0.1).')
+    parser.add_option('--stop-delay', type='float', default=0.1,
+        help='The seconds icms-stop.py takes (default: 0.1).')
+    parser.add_option('--reindex-delay', type='float', default=0.5,
+        help='The seconds icms-update-catalog.py takes (default: 0.5).')
+    parser.add_option('--phases', default=phases,
+        help='The pyenv actions to measure, comma separated (default: %s; '
+             'see also deploy, deploy_reindex and deploy_reindex_online).'
+             % phases)
+    parser.add_option('-j', '--jobs', type='int', default=1,
+        help='The --jobs option of usine.py (default: 1).')
+    parser.add_option('--runs', type='int', default=2,
+        help='The number of times to run every phase, the first run is '
+             'cold, the next ones find everything done (default: 2).')
+    parser.add_option('--json',
+        help='Also write the report as JSON to the given file.')
+    parser.add_option('--chrome-trace',
+        help='Also write the spans recorded by usine, see tracing.py.')
+    parser.add_option('--keep', action='store_true',
+        help='Do not remove the temporary folder.')
+    parser.add_option('-v', '--verbose', action='store_true',
+        help='Print the output of usine.')
+    options, args = parser.parse_args()
+
+    # The world, within a temporary HOME
+    root = mkdtemp(prefix='usine-benchmark-')
+    home = join(root, 'home')
+    os.makedirs(home)
+    os.environ['HOME'] = home
+    for path in glob('/tmp/usine-bench-pkg-*'):
+        os.remove(path)
+    stats_path = join(root, 'stats.sock')
+    server, port = start_server(home, stats_path)
+    report = []
+    try:
+        delays = {'start': options.start_delay, 'stop': options.stop_delay,
+                  'update-catalog': options.reindex_delay}
+        make_world(root, home, options.packages, options.pyenvs,
+                   options.instances, options.size, delays, port)
+        print 'World: %d packages x %d pyenvs x %d instances, in %s' % (
+            options.packages, options.pyenvs, options.instances, root)
+
+        # Import from usine, now HOME is set
+        from libusine import config, hosts, modules, tracing
+        hosts.use_agent = False
+        tracing.enabled = bool(options.chrome_trace)
+        error = config.load()
+        if error:
+            print error
+            sys.exit(1)
+        config.options = Values({
+            'offline': False, 'branch': 'master', 'jobs': options.jobs,
+            'jobs_per_host': None, 'batch': '1', 'timeout': 60,
+            'samples': 5, 'json': None, 'dry_run': False})
+
+        pyenvs = config.get_sections_by_type('pyenv')
+        pyenv = modules['pyenv']
+        stdout = sys.stdout
+        for run in range(1, options.runs + 1):
+            for phase in options.phases.split(','):
+                def call():
+                    pyenv.run_action(pyenvs, phase, options.jobs,
+                                     options.jobs)
+                if not options.verbose:
+                    sys.stdout = open(os.devnull, 'w')
+                try:
+                    cost = measure(stats_path, call)
+                finally:
+                    sys.stdout = stdout
+                report.append((run, phase, cost))
+                print '[OK] run %d, %s (%.2f s)' % (run, phase, cost['wall'])
+            # Query the hosts again in the next run
+            for x in pyenvs:
+                x.installed = x.outdated = None
+
+        for host in hosts.remote_hosts.values():
+            host.close()
+    finally:
+        server.terminate()
+        server.wait()
+        if not options.keep:
+            rmtree(root)
+
+    # Report
+    print_report(report)
+    if options.json:
+        world = {'packages': options.packages, 'pyenvs': options.pyenvs,
+                 'instances': options.instances, 'size': options.size,
+                 'jobs': options.jobs}
+        results = [ dict(cost, run=run, phase=phase)
+                    for run, phase, cost in report ]
+        with open(options.json, 'w') as file:
+            file.write(dumps({'world': world, 'phases': results}) + '\n')
+    if options.chrome_trace:
+        tracing.export_chrome(options.chrome_trace)
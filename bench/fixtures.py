@@ -0,0 +1,161 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2009-2010 Juan David Ibáñez Palomar <jdavid@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+import os
+from os.path import join
+from subprocess import check_call
+import sys
+
+
+"""
+The synthetic world the benchmarks deploy to, all within a temporary HOME:
+
+- a mirror of N bare git repositories, every one a Python package
+- M Python environments, whose interpreter is this one, with fake
+  icms-*.py scripts that only sleep for the given delays
+- K ikaaro instances for every environment
+- the usine configuration (~/.usine/bench.ini), the environments are
+  reached through the local SSH server (see sshserver.py)
+"""
+
+
+def get_package_name(i):
+    return 'usine-bench-pkg-%02d' % i
+
+
+
+setup_py = """from distutils.core import setup
+setup(name=%r, version='1.0', py_modules=[%r])
+"""
+
+
+def make_mirror(root, n, size):
+    """Makes N bare repositories in <root>/mirror, every one a package with
+    a module of the given size (in KB).  Returns the URL of the mirror.
+    """
+    mirror = join(root, 'mirror')
+    os.makedirs(mirror)
+    for i in range(1, n + 1):
+        name = get_package_name(i)
+        module = name.replace('-', '_')
+        source = join(root, 'src', name)
+        os.makedirs(source)
+        with open(join(source, 'setup.py'), 'w') as file:
+            file.write(setup_py % (name, module))
+        with open(join(source, '%s.py' % module), 'w') as file:
+            # Random data, so the package does not compress away
+            file.write('DATA = %r\n' % os.urandom(size * 1024).encode('hex'))
+
+        git = ['git', '-c', 'user.name=bench',
+               '-c', 'user.email=bench@localhost']
+        check_call(['git', 'init', '-q', source])
+        check_call(git + ['add', '.'], cwd=source)
+        check_call(git + ['commit', '-q', '-m', 'bench'], cwd=source)
+        check_call(['git', 'branch', '-q', '-M', 'master'], cwd=source)
+        check_call(['git', 'clone', '-q', '--bare', source,
+                    join(mirror, '%s.git' % name)])
+    return 'file://%s/' % mirror
+
+
+
+icms_script = """#!%(python)s
+import os, sys, time
+time.sleep(%(delay)s)
+path = [ x for x in sys.argv[1:] if not x.startswith('-') ][-1]
+%(body)s
+"""
+
+icms_bodies = {
+    'start': "open(os.path.join(path, 'pid'), 'w').write(str(os.getpid()))",
+    'stop': (
+        "if os.path.exists(os.path.join(path, 'pid')):\n"
+        "    os.remove(os.path.join(path, 'pid'))"),
+    'update-catalog': (
+        "catalog = os.path.join(path, 'catalog')\n"
+        "if not os.path.exists(catalog):\n"
+        "    os.makedirs(catalog)\n"
+        "open(os.path.join(catalog, 'data'), 'w').write('x' * 4096)")}
+
+
+def make_pyenv(home, name, k, delays):
+    """Makes the Python environment ~/bench/<name>, with K instances.
+    The delays are {'start': seconds, 'stop': .., 'update-catalog': ..}.
+    """
+    path = join(home, 'bench', name)
+    bin = join(path, 'bin')
+    os.makedirs(bin)
+    os.symlink(sys.executable, join(bin, 'python'))
+    for command, body in icms_bodies.items():
+        script = join(bin, 'icms-%s.py' % command)
+        with open(script, 'w') as file:
+            file.write(icms_script % {'python': sys.executable,
+                                      'delay': delays[command],
+                                      'body': body})
+        os.chmod(script, 0755)
+    for i in range(1, k + 1):
+        os.makedirs(join(path, 'inst-%d' % i, 'catalog'))
+
+
+
+def make_ssh_key(home):
+    """The key the client authenticates with, the server accepts any.
+    """
+    from paramiko import RSAKey
+    folder = join(home, '.ssh')
+    os.makedirs(folder)
+    RSAKey.generate(2048).write_private_key_file(join(folder, 'id_rsa'))
+
+
+
+def make_config(home, mirror_url, port, n, m, k):
+    lines = [
+        '[mirror bench]', 'url = %s' % mirror_url, '',
+        '[server bench]', 'host = 127.0.0.1:%s' % port, '']
+    packages = []
+    for i in range(1, n + 1):
+        name = get_package_name(i)
+        packages.append('%s:master' % name)
+        lines.extend(['[pysrc %s]' % name, 'mirror = bench', ''])
+    for i in range(1, m + 1):
+        pyenv = 'pyenv-%d' % i
+        lines.extend([
+            '[pyenv %s]' % pyenv,
+            'location = bench@bench:bench/%s' % pyenv,
+            'prefix = ~/bench/%s' % pyenv,
+            'packages = %s' % ' '.join(packages), ''])
+        for j in range(1, k + 1):
+            lines.extend([
+                '[ikaaro %s-inst-%d]' % (pyenv, j),
+                'pyenv = %s' % pyenv,
+                'path = inst-%d' % j, ''])
+
+    folder = join(home, '.usine')
+    os.makedirs(folder)
+    with open(join(folder, 'bench.ini'), 'w') as file:
+        file.write('\n'.join(lines))
+
+
+
+def make_world(root, home, n, m, k, size, delays, port):
+    """Makes everything but the SSH server: the mirror within the root
+    folder, the rest within the given HOME.
+    """
+    mirror_url = make_mirror(root, n, size)
+    for i in range(1, m + 1):
+        make_pyenv(home, 'pyenv-%d' % i, k, delays)
+    make_ssh_key(home)
+    make_config(home, mirror_url, port, n, m, k)
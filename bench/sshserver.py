@@ -0,0 +1,358 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2009-2010 Juan David Ibáñez Palomar <jdavid@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from json import dumps, loads
+import os
+from os.path import expanduser, join, normpath
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+import socket
+from subprocess import PIPE, Popen
+import sys
+from threading import Lock, Thread
+
+# Import from paramiko
+from paramiko import AUTH_SUCCESSFUL, OPEN_SUCCEEDED, RSAKey, SFTP_OK
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer
+from paramiko import SFTPServerInterface, ServerInterface, Transport
+from paramiko import OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+"""
+A local SSH server for the benchmarks, which accepts any user and key, and
+runs the commands as the current user (with its HOME).  It supports exec
+and shell channels, and SFTP.
+
+It counts the round-trips (commands and SFTP requests), the bytes moved,
+and its CPU time; they are sent as JSON to whoever connects to the stats
+socket.
+
+Usage: python sshserver.py <stats socket>
+
+It listens on a free port of 127.0.0.1, and prints the port number.
+"""
+
+
+BUFFER_SIZE = 32768
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {
+            'commands': 0,
+            'sftp_requests': 0,
+            'bytes_in': 0,
+            'bytes_out': 0}
+
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+
+    def get(self):
+        with self.lock:
+            stats = dict(self.counters)
+        cpu = 0.0
+        for who in [RUSAGE_SELF, RUSAGE_CHILDREN]:
+            usage = getrusage(who)
+            cpu += usage.ru_utime + usage.ru_stime
+        stats['cpu'] = cpu
+        return stats
+
+
+stats = Stats()
+
+
+
+###########################################################################
+# Commands
+###########################################################################
+def pump_input(channel, process):
+    try:
+        data = channel.recv(BUFFER_SIZE)
+        while data:
+            stats.add('bytes_in', len(data))
+            process.stdin.write(data)
+            process.stdin.flush()
+            data = channel.recv(BUFFER_SIZE)
+    except (IOError, socket.error):
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except IOError:
+            pass
+
+
+
+def pump_output(file, send):
+    fd = file.fileno()
+    data = os.read(fd, BUFFER_SIZE)
+    while data:
+        stats.add('bytes_out', len(data))
+        send(data)
+        data = os.read(fd, BUFFER_SIZE)
+
+
+
+def run_process(channel, command):
+    process = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                    cwd=expanduser('~'), close_fds=True)
+    stdin = Thread(target=pump_input, args=(channel, process))
+    stdin.daemon = True
+    stdin.start()
+    stderr = Thread(target=pump_output,
+                    args=(process.stderr, channel.sendall_stderr))
+    stderr.start()
+    try:
+        pump_output(process.stdout, channel.sendall)
+    except socket.error:
+        pass
+    stderr.join()
+    status = process.wait()
+    try:
+        channel.send_exit_status(status)
+        channel.shutdown_write()
+    except (EOFError, socket.error):
+        pass
+
+
+
+def start_process(channel, command):
+    stats.add('commands')
+    thread = Thread(target=run_process, args=(channel, command))
+    thread.daemon = True
+    thread.start()
+
+
+
+class Server(ServerInterface):
+
+    def get_allowed_auths(self, username):
+        return 'publickey,password'
+
+
+    def check_auth_publickey(self, username, key):
+        return AUTH_SUCCESSFUL
+
+
+    def check_auth_password(self, username, password):
+        return AUTH_SUCCESSFUL
+
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return OPEN_SUCCEEDED
+        return OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+    def check_channel_pty_request(self, channel, term, width, height,
+                                  pixelwidth, pixelheight, modes):
+        return True
+
+
+    def check_channel_exec_request(self, channel, command):
+        start_process(channel, ['/bin/sh', '-c', command])
+        return True
+
+
+    def check_channel_shell_request(self, channel):
+        start_process(channel, ['/bin/sh'])
+        return True
+
+
+
+###########################################################################
+# SFTP
+###########################################################################
+class Handle(SFTPHandle):
+
+    def read(self, offset, length):
+        data = SFTPHandle.read(self, offset, length)
+        if type(data) is str:
+            stats.add('bytes_out', len(data))
+        return data
+
+
+    def write(self, offset, data):
+        stats.add('bytes_in', len(data))
+        return SFTPHandle.write(self, offset, data)
+
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError, error:
+            return SFTPServer.convert_errno(error.errno)
+
+
+
+def counted(method):
+    def counted_method(self, *args):
+        stats.add('sftp_requests')
+        try:
+            return method(self, *args)
+        except OSError, error:
+            return SFTPServer.convert_errno(error.errno)
+    return counted_method
+
+
+
+class SFTPInterface(SFTPServerInterface):
+    """Serves the file system of the current user, relative paths are
+    relative to its HOME.
+    """
+
+    def canonicalize(self, path):
+        stats.add('sftp_requests')
+        return normpath(join(expanduser('~'), path))
+
+
+    @counted
+    def list_folder(self, path):
+        return [ SFTPAttributes.from_stat(os.lstat(join(path, x)), x)
+                 for x in os.listdir(path) ]
+
+
+    @counted
+    def stat(self, path):
+        return SFTPAttributes.from_stat(os.stat(path))
+
+
+    @counted
+    def lstat(self, path):
+        return SFTPAttributes.from_stat(os.lstat(path))
+
+
+    @counted
+    def open(self, path, flags, attr):
+        mode = getattr(attr, 'st_mode', None) or 0666
+        fd = os.open(path, flags, mode)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+
+    @counted
+    def remove(self, path):
+        os.remove(path)
+        return SFTP_OK
+
+
+    @counted
+    def rename(self, oldpath, newpath):
+        if os.path.exists(newpath):
+            return SFTPServer.convert_errno(17)
+        os.rename(oldpath, newpath)
+        return SFTP_OK
+
+
+    @counted
+    def posix_rename(self, oldpath, newpath):
+        os.rename(oldpath, newpath)
+        return SFTP_OK
+
+
+    @counted
+    def mkdir(self, path, attr):
+        os.mkdir(path)
+        return SFTP_OK
+
+
+    @counted
+    def rmdir(self, path):
+        os.rmdir(path)
+        return SFTP_OK
+
+
+    @counted
+    def chattr(self, path, attr):
+        SFTPServer.set_file_attr(path, attr)
+        return SFTP_OK
+
+
+
+###########################################################################
+# Server
+###########################################################################
+def serve_connection(client, host_key):
+    transport = Transport(client)
+    transport.add_server_key(host_key)
+    transport.set_subsystem_handler('sftp', SFTPServer, SFTPInterface)
+    transport.start_server(server=Server())
+    # The channels are served by the callbacks of Server.  Do not accept
+    # them: a channel is closed once it is garbage collected.
+    transport.join()
+
+
+
+def serve_stats(path):
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(5)
+    while True:
+        client = server.accept()[0]
+        client.sendall(dumps(stats.get()))
+        client.close()
+
+
+
+def get_stats(path):
+    """Returns the counters of the server listening on the given stats
+    socket.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    data = []
+    chunk = client.recv(BUFFER_SIZE)
+    while chunk:
+        data.append(chunk)
+        chunk = client.recv(BUFFER_SIZE)
+    client.close()
+    return loads(''.join(data))
+
+
+
+if __name__ == '__main__':
+    host_key = RSAKey.generate(2048)
+
+    thread = Thread(target=serve_stats, args=(sys.argv[1],))
+    thread.daemon = True
+    thread.start()
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', 0))
+    server.listen(100)
+    print server.getsockname()[1]
+    sys.stdout.flush()
+    while True:
+        client = server.accept()[0]
+        thread = Thread(target=serve_connection, args=(client, host_key))
+        thread.daemon = True
+        thread.start()
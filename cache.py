@@ -0,0 +1,66 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2009-2010 Juan David Ibáñez Palomar <jdavid@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from hashlib import sha1
+from json import dumps, loads
+from os import getpid, makedirs, rename
+from os.path import exists, expanduser
+from threading import current_thread
+
+
+"""
+This module provides a persistent key/value store, kept in the ~/.usine/var
+folder, to remember the result of costly operations between invocations.
+
+Values are JSON serializable objects.  Every key is stored in its own file,
+written to a temporary name first and then renamed, so concurrent writers
+never leave a partial value behind.
+"""
+
+
+def get_cache_path(namespace, key=None):
+    path = expanduser('~/.usine/var/%s' % namespace)
+    if key is None:
+        return path
+    return '%s/%s' % (path, sha1(key).hexdigest())
+
+
+
+def get_value(namespace, key, default=None):
+    path = get_cache_path(namespace, key)
+    try:
+        with open(path) as file:
+            return loads(file.read())
+    except (IOError, ValueError):
+        return default
+
+
+
+def set_value(namespace, key, value):
+    folder = get_cache_path(namespace)
+    if not exists(folder):
+        try:
+            makedirs(folder)
+        except OSError:
+            # Made meanwhile by another thread
+            pass
+
+    path = get_cache_path(namespace, key)
+    tmp = '%s.tmp-%s-%s' % (path, getpid(), current_thread().ident)
+    with open(tmp, 'w') as file:
+        file.write(dumps(value))
+    rename(tmp, path)
@@ -16,11 +16,15 @@
 
 # Import from the Standard Library
 from ConfigParser import RawConfigParser
-from os.path import expanduser
+from fnmatch import fnmatchcase
+from marshal import dumps, loads
+from os import getpid, makedirs, rename
+from os.path import dirname, exists, expanduser, getmtime
+import sys
+from threading import Lock
 
 # Import from itools
 from itools.core import freeze
-from itools.fs import lfs
 
 # Import from usine
 from hosts import local
@@ -28,17 +32,119 @@ from modules import modules, register_module
 
 
 
+# Change it when the format of the index changes
+INDEX_VERSION = 2
+
+
+def get_index_path():
+    return expanduser('~/.usine/var/config.index')
+
+
+
+def read_index(path):
+    """Returns the index of the configuration, or None if it does not exist
+    or if any of its source files (the INI files, and their folder to know
+    of files added or removed) changed since it was made.
+    """
+    try:
+        with open(path, 'rb') as file:
+            index = loads(file.read())
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+    version = (INDEX_VERSION, tuple(sys.version_info[:2]))
+    if type(index) is not dict or index.get('version') != version:
+        return None
+    for source, mtime in index['sources'].iteritems():
+        try:
+            if getmtime(source) != mtime:
+                return None
+        except OSError:
+            return None
+    return index
+
+
+
+def make_index(folder, ini):
+    """Parses the given INI files, and returns the index of the
+    configuration:
+
+    - sections: {(type, name): options}
+    - by_type: {type: [name, ...]}, sorted by name
+    - referrers: {(type, name): {type: [name, ...]}}, the sections that refer
+      to every section (e.g. the ikaaro instances of a pyenv)
+    """
+    cfg = RawConfigParser()
+    cfg.read(ini)
+
+    sections = {}
+    by_type = {}
+    referrers = {}
+    for section in cfg.sections():
+        type, name = section.split()
+        # The options of the section alone, without the defaults
+        options = dict(cfg._sections[section])
+        options['__name__'] = section
+        sections[(type, name)] = options
+        by_type.setdefault(type, []).append(name)
+        for key in modules[type].get_references(options):
+            names = referrers.setdefault(key, {}).setdefault(type, [])
+            names.append(name)
+
+    # Sort
+    for names in by_type.values():
+        names.sort()
+    for value in referrers.values():
+        for names in value.values():
+            names.sort()
+
+    sources = {}
+    for path in [folder] + ini:
+        sources[path] = getmtime(path)
+    return {
+        'version': (INDEX_VERSION, tuple(sys.version_info[:2])),
+        'sources': sources,
+        'sections': sections,
+        'by_type': by_type,
+        'referrers': referrers}
+
+
+
+def write_index(path, index):
+    folder = dirname(path)
+    if not exists(folder):
+        makedirs(folder)
+    tmp = '%s.tmp-%s' % (path, getpid())
+    with open(tmp, 'wb') as file:
+        file.write(dumps(index))
+    rename(tmp, path)
+
+
+
 class configuration(object):
+    """The configuration is read from the INI files in ~/.usine, through an
+    index (see make_index) kept in ~/.usine/var, and made again only when
+    an INI file changes.  The sections are made on demand.
+    """
 
     class_title = u'Manage configuration'
     class_actions = freeze([''])
 
     def __init__(self):
-        self.by_type = {}            # type: [<data>, ..]
-        self.by_type_and_name = {}   # (type, name): <data>
+        self.index = None
+        self.sections = {}   # (type, name): <module>
+        self.lock = Lock()
 
     def load(self):
         path = expanduser('~/.usine')
+        # Read the index, unless an INI file changed
+        index_path = get_index_path()
+        self.index = read_index(index_path)
+        if self.index is not None:
+            return
+
+        # Loading itools.fs is slow, only do it when the index is made
+        from itools.fs import lfs
         if lfs.is_file(path):
             return 'ERROR: %s is a file, remove it first' % path
 
@@ -54,24 +160,9 @@ class configuration(object):
         if len(ini) == 0:
             return 'ERROR: zero INI files found in %s/' % path
 
-        # Read the ini file
-        cfg = RawConfigParser()
-        cfg.read(ini)
-
-        # Get the data
-        for section in cfg._sections:
-            options = cfg._sections[section]
-            type, name = section.split()
-            module = modules[type]
-            obj = module(options)
-
-            # Keep the data unit
-            self.by_type.setdefault(type, []).append(obj)
-            self.by_type_and_name[(type, name)] = obj
-
-        # Sort
-        for type in self.by_type:
-            self.by_type[type].sort(key=lambda x: x.name)
+        # Index
+        self.index = make_index(path, ini)
+        write_index(index_path, self.index)
 
 
     update_title = u'Update usine configuration'
@@ -79,6 +170,7 @@ class configuration(object):
         """
         If config folder is a GIT repository, rebase it
         """
+        from itools.fs import lfs
         print '**********************************************************'
         print ' UPDATE USINE CONFIGURATION'
         print '**********************************************************'
@@ -90,13 +182,59 @@ class configuration(object):
                 local.run(['git', 'reset', '--hard', 'origin/master'], cwd=folder)
 
 
+    def get_names_by_type(self, type):
+        return self.index['by_type'].get(type, [])
+
+
     def get_sections_by_type(self, type):
-        return self.by_type.get(type, [])
+        return [ self.get_section(type, x)
+                 for x in self.get_names_by_type(type) ]
 
 
     def get_section(self, type, name):
         key = (type, name)
-        return self.by_type_and_name.get(key)
+        with self.lock:
+            section = self.sections.get(key)
+            if section is None:
+                options = self.index['sections'].get(key)
+                if options is None:
+                    return None
+                section = self.sections[key] = modules[type](options)
+            return section
+
+
+    def get_referrers(self, type, name, referrer_type):
+        """Returns the sections of the given type that refer to the given
+        section (see module.get_references).
+        """
+        referrers = self.index['referrers'].get((type, name), {})
+        return [ self.get_section(referrer_type, x)
+                 for x in referrers.get(referrer_type, []) ]
+
+
+    def select_sections(self, type, selector):
+        """Returns the sections of the given type matching the selector, a
+        comma separated list of:
+
+        - 'all', every section
+        - a name, or a glob pattern matching names (e.g. 'prod-*')
+        - 'tag:<tag>', the sections with the tag in their 'tags' option
+        """
+        names = self.get_names_by_type(type)
+        sections = self.index['sections']
+        selected = set()
+        for pattern in selector.split(','):
+            for name in names:
+                if pattern == 'all':
+                    selected.add(name)
+                elif pattern.startswith('tag:'):
+                    tags = sections[(type, name)].get('tags', '').split()
+                    if pattern[4:] in tags:
+                        selected.add(name)
+                elif fnmatchcase(name, pattern):
+                    selected.add(name)
+
+        return [ self.get_section(type, x) for x in names if x in selected ]
 
 
 # singleton
@@ -15,19 +15,28 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from base64 import b64encode
 from contextlib import closing
 from getpass import getpass
-from os.path import basename, expanduser
+from hashlib import sha1
+from json import dumps, loads
+from os.path import basename, expanduser, getsize
+from pipes import quote
+from re import compile
+from select import select
 import socket
 from stat import S_ISDIR
-from sys import stdout
-
-# Import from paramiko
-from paramiko import AutoAddPolicy, SSHClient, PasswordRequiredException
+import sys
+from threading import Lock
+from time import time
 
 # Import from itools
 from itools.core import get_pipe
 
+# Import from usine
+from jobs import get_lock
+from tracing import span
+
 
 """
 This module provides a common interface to access the localhost and to
@@ -36,10 +45,43 @@ access a remote host (through paramiko).  The common API is:
 - run: to execute a command
 
 - put: to copy a file
+
+- put_many: to copy many files at once
 """
 
 
 
+###########################################################################
+# Python scripts
+###########################################################################
+RESULT = 'USINE-RESULT '
+
+
+def get_python_code(script, data):
+    """Returns a one-line Python program, safe to put between double quotes
+    on a command line, that runs the given script with the variable 'data'
+    set to the given (JSON serializable) value.  To report results, the
+    script prints lines made of RESULT followed by a JSON object.
+    """
+    data = b64encode(dumps(data))
+    script = b64encode('RESULT = %r\n%s' % (RESULT, script))
+    code = (
+        'import base64, json; data = json.loads(base64.b64decode(\'%s\'));'
+        ' exec(base64.b64decode(\'%s\'))')
+    return code % (data, script)
+
+
+
+def parse_results(output):
+    results = []
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith(RESULT):
+            results.append(loads(line[len(RESULT):]))
+    return results
+
+
+
 ###########################################################################
 # Local host
 ###########################################################################
@@ -53,9 +95,13 @@ class LocalHost(object):
 
 
     def run(self, command, cwd=None):
-        # Change dir
+        # Change dir (keep the working directory of this call in a local
+        # variable, so concurrent calls do not step on each other)
         if cwd:
-            self.chdir(cwd)
+            cwd = expanduser(cwd)
+            self.cwd = cwd
+        else:
+            cwd = self.cwd
         # Format command
         if type(command) is str:
             command = expanduser(command)
@@ -64,153 +110,617 @@ class LocalHost(object):
         else:
             command_str = ' '.join(command)
         # Print
-        print '%s $ %s' % (self.cwd, command_str)
+        print '%s $ %s' % (cwd, command_str)
         # Call
-        return get_pipe(command, cwd=self.cwd)
+        with span('run', 'host', host='localhost', command=command_str) as s:
+            try:
+                output = get_pipe(command, cwd=cwd)
+            except EnvironmentError, error:
+                s.set(status=error.errno)
+                raise
+            s.set(status=0, bytes=len(output))
+        return output
+
+
+    def run_python(self, bin_python, script, data, cwd=None):
+        """Runs the given Python script with the given interpreter, see
+        get_python_code.  Returns the results the script has printed.
+        """
+        bin_python = expanduser(bin_python)
+        code = get_python_code(script, data)
+        cwd = expanduser(cwd) if cwd else self.cwd
+        print '%s $ %s -c ...' % (cwd, bin_python)
+        with span('run_python', 'host', host='localhost',
+                  command=bin_python) as s:
+            try:
+                output = get_pipe([bin_python, '-c', code], cwd=cwd)
+            except EnvironmentError, error:
+                s.set(status=error.errno)
+                raise
+            s.set(status=0, bytes=len(output))
+        return parse_results(output)
 
 
     def put(self, source, target):
         raise NotImplementedError
 
 
+    def put_many(self, sources, target):
+        raise NotImplementedError
+
+
 
 ###########################################################################
 # Remote host
 ###########################################################################
-def read_from_channel(recv):
-    buffer = []
-    try:
-        data = recv(1024)
-        while data:
-            buffer.append(data)
-            data = recv(1024)
-    except socket.timeout:
-        pass
+def write_output(data):
+    # Not bound to the stdout at import time, as the agent replaces it
+    sys.stdout.write(data)
+    sys.stdout.flush()
+
 
-    return ''.join(buffer)
 
+BUFFER_SIZE = 32768
 
 
-def run_with_shell(channel, cwd, command):
-    command = 'cd %s\n%s\necho EOF\n' % (cwd, command)
+def read_from_channel(channel):
+    """Reads from the channel as the data arrives.  Yields pairs (stream,
+    data) where stream is either 'stdout' or 'stderr'; stops once the remote
+    side has sent EOF and every buffered byte has been read.
+
+    Waits with select, so it does not use any CPU while waiting.
+    """
+    while True:
+        select([channel], [], [])
+        ready = False
+        if channel.recv_stderr_ready():
+            ready = True
+            yield 'stderr', channel.recv_stderr(BUFFER_SIZE)
+        if channel.recv_ready():
+            ready = True
+            data = channel.recv(BUFFER_SIZE)
+            if data:
+                yield 'stdout', data
+        if not ready and (channel.eof_received or channel.closed):
+            return
+
+
+
+# The shell prints this after the command, followed by its exit status.
+# It is split in the command line, so the echo of the input by the
+# terminal is not mistaken for it.
+EOF_MARK = '__USINE_EOF__'
+EOF_COMMAND = 'echo "%s""%s $?"' % (EOF_MARK[:7], EOF_MARK[7:])
+EOF_REGEX = compile(r'%s (\d+)\r?\n' % EOF_MARK)
+
+
+def split_eof(data):
+    """Splits the data in two: the part that is output for sure, and the
+    end that may be the start of the EOF mark (or the mark without its
+    status yet).
+    """
+    index = data.find(EOF_MARK)
+    if index != -1:
+        return data[:index], data[index:]
+    for n in range(min(len(EOF_MARK) - 1, len(data)), 0, -1):
+        if data.endswith(EOF_MARK[:n]):
+            return data[:-n], data[-n:]
+    return data, ''
+
+
+
+def run_with_shell(channel, cwd, command, echo=True):
+    """Runs the command through an interactive shell.  Returns the exit
+    status and the standard output.  The output is printed as it arrives,
+    unless 'echo' is false.  Raises EnvironmentError if the shell quits,
+    or the channel is closed, before the end of the command.
+    """
+    command = 'cd %s\n%s\n%s\n' % (cwd, command, EOF_COMMAND)
 
     # Call
     channel.invoke_shell()
-    channel.settimeout(0.0)
     channel.send(command)
-    while True:
-        data = read_from_channel(channel.recv)
-        # Check EOF
-        if not data or data.endswith('EOF\n'):
-            data = data[:-4]
-            stdout.write(data)
-            stdout.flush()
+    output = []
+    pending = ''
+    status = None
+    for stream, data in read_from_channel(channel):
+        if stream == 'stderr':
+            if echo:
+                write_output(data)
+            continue
+
+        # Look for the EOF mark, it may be split across reads: keep back
+        # the end of the data that could be the start of the mark
+        pending += data
+        match = EOF_REGEX.search(pending)
+        if match:
+            data = pending[:match.start()]
+            status = int(match.group(1))
+            pending = ''
+        else:
+            data, pending = split_eof(pending)
+        if echo:
+            write_output(data)
+        output.append(data)
+        if status is not None:
             break
-        stdout.write(data)
-        stdout.flush()
-    # Error
-    data = read_from_channel(channel.recv_stderr)
-    if data:
-        stdout.write(data)
-        stdout.flush()
+
+    # The shell quit before printing the mark
+    if pending:
+        if echo:
+            write_output(pending)
+        output.append(pending)
+    if status is None:
+        msg = 'the shell quit before the end of the command'
+        raise EnvironmentError, (None, msg)
+
+    return status, ''.join(output)
 
 
 
-def run_without_shell(channel, cwd, command):
+def run_without_shell(channel, cwd, command, echo=True):
+    """Executes the command.  Returns the exit status, the standard output
+    and the error output.  Both outputs are printed as they arrive, unless
+    'echo' is false.
+    """
     command = 'cd %s && %s' % (cwd, command)
 
     # Call
     channel.exec_command(command)
+    output = {'stdout': [], 'stderr': []}
+    for stream, data in read_from_channel(channel):
+        if echo:
+            write_output(data)
+        output[stream].append(data)
     status = channel.recv_exit_status()
-    if status:
-        print 'ERROR'
-        data = channel.recv_stderr(512)
-        while data:
-            stdout.write(data)
-            stdout.flush()
-            data = channel.recv_stderr(512)
-    else:
-        data = channel.recv(512)
+    return status, ''.join(output['stdout']), ''.join(output['stderr'])
+
+
+
+def quote_path(path):
+    """Quotes the given path for the remote shell, but lets it expand the
+    tilde.
+    """
+    # The slash after the tilde must not be quoted, else it is not expanded
+    if path == '~':
+        return path
+    if path.startswith('~/'):
+        return '~/%s' % quote(path[2:])
+    return quote(path)
+
+
+
+def get_checksum(path):
+    checksum = sha1()
+    with open(path, 'rb') as file:
+        data = file.read(65536)
         while data:
-            stdout.write(data)
-            stdout.flush()
-            data = channel.recv(512)
+            checksum.update(data)
+            data = file.read(65536)
+    return checksum.hexdigest()
+
+
+
+def read_command(channel, command):
+    """Executes the given command and returns its standard output, raises
+    EnvironmentError if it fails.
+    """
+    channel.exec_command(command)
+    stdout = channel.makefile('rb').read()
+    stderr = channel.makefile_stderr('rb').read()
+    status = channel.recv_exit_status()
+    if status:
+        raise EnvironmentError, (status, stderr)
+    return stdout
+
+
+
+class ChannelWriter(object):
+    """File-like object to write to a channel, counts the bytes written.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.size = 0
+
+
+    def write(self, data):
+        self.channel.sendall(data)
+        self.size += len(data)
+
+
+
+def format_rate(size, seconds):
+    rate = size / seconds if seconds else 0.0
+    for unit in ['B', 'KB', 'MB']:
+        if rate < 1024:
+            break
+        rate = rate / 1024
+    return '%.1f %s/s' % (rate, unit)
+
+
+
+# The passphrase of the SSH key, asked once for every connection
+passphrase = None
+
+def ask_passphrase():
+    return getpass('Enter passphrase for key: ')
 
 
 
 class RemoteHost(object):
 
+    # Seconds between keepalive messages, so idle connections are not
+    # dropped by firewalls
+    keepalive = 30
+
     def __init__(self, host, user, shell):
         host, port = host.split(':')
         self.host = host
         self.port = int(port)
         self.user = user
         self.shell = shell # True or False
+        self.cwd = None
         # Connection
         self.ssh = None
+        self.lock = Lock()
 
 
     def chdir(self, cwd):
         self.cwd = cwd
 
 
+    def connect(self):
+        global passphrase
+        # Loading paramiko is slow, only do it when connecting
+        from paramiko import AutoAddPolicy, SSHClient
+        from paramiko import PasswordRequiredException
+
+        print 'Connect %s@%s:%s' % (self.user, self.host, self.port)
+        ssh = SSHClient()
+        ssh.load_system_host_keys()
+        ssh.set_missing_host_key_policy(AutoAddPolicy())
+        try:
+            ssh.connect(self.host, self.port, self.user, passphrase)
+        except PasswordRequiredException:
+            passphrase = ask_passphrase()
+            ssh.connect(self.host, self.port, self.user, passphrase)
+        ssh.get_transport().set_keepalive(self.keepalive)
+        return ssh
+
+
     @property
     def transport(self):
-        if self.ssh is None:
-            print 'Connect %s@%s:%s' % (self.user, self.host, self.port)
-            ssh = SSHClient()
-            ssh.load_system_host_keys()
-            ssh.set_missing_host_key_policy(AutoAddPolicy())
-            try:
-                ssh.connect(self.host, self.port, self.user)
-            except PasswordRequiredException:
-                password = getpass('Enter passphrase for key: ')
-                ssh.connect(self.host, self.port, self.user, password)
-            self.ssh = ssh
-        return self.ssh.get_transport()
+        """The transport, connected (again if the connection was lost).
+        """
+        with self.lock:
+            if self.ssh is not None:
+                transport = self.ssh.get_transport()
+                if transport is None or not transport.is_active():
+                    print 'Connection to %s@%s:%s lost' % (
+                        self.user, self.host, self.port)
+                    self.ssh.close()
+                    self.ssh = None
+            if self.ssh is None:
+                self.ssh = self.connect()
+            return self.ssh.get_transport()
+
+
+    def open_session(self):
+        """Opens a new channel.  Connects again, once, if the connection
+        turns out to be dead.
+        """
+        from paramiko import SSHException
+        try:
+            return self.transport.open_session()
+        except (SSHException, socket.error, EOFError):
+            self.close()
+            return self.transport.open_session()
+
+
+    def open_sftp(self):
+        from paramiko import SSHException
+        try:
+            return self.transport.open_sftp_client()
+        except (SSHException, socket.error, EOFError):
+            self.close()
+            return self.transport.open_sftp_client()
 
 
     def close(self):
-        if self.ssh:
-            self.ssh.close()
-            self.ssh = None
+        with self.lock:
+            if self.ssh:
+                self.ssh.close()
+                self.ssh = None
 
 
     def run(self, command, cwd=None, quiet=False):
-        # Change dir
+        """Runs the command, printing its output as it arrives.  Returns
+        the standard output; raises EnvironmentError if the command fails.
+        """
+        # Change dir (keep the working directory of this call in a local
+        # variable, so concurrent calls do not step on each other)
         if cwd:
-            self.chdir(cwd)
+            self.cwd = cwd
+        else:
+            cwd = self.cwd
 
         # Print
         if quiet is False:
-            print '%s@%s %s $ %s' % (self.user, self.host, self.cwd, command)
+            print '%s@%s %s $ %s' % (self.user, self.host, cwd, command)
+
+        with span('run', 'host', host=self.host, command=command) as s:
+            status, output, error = self._run(command, cwd, True)
+            s.set(status=status, bytes=len(output) + len(error))
+
+        # Like LocalHost.run (see itools.core.get_pipe)
+        if status:
+            raise EnvironmentError, (status, error)
+        return output
+
 
-        channel = self.transport.open_channel('session')
+    def _run(self, command, cwd, echo):
+        # Returns the exit status, the standard output and the error output
+        channel = self.open_session()
         try:
             if self.shell:
-                run_with_shell(channel, self.cwd, command)
-            else:
-                run_without_shell(channel, self.cwd, command)
+                status, output = run_with_shell(channel, cwd, command, echo)
+                return status, output, ''
+            return run_without_shell(channel, cwd, command, echo)
         finally:
             channel.close()
 
 
+    def run_python(self, bin_python, script, data, cwd=None):
+        """Runs the given Python script with the remote interpreter, see
+        get_python_code.  Returns the results the script has printed.
+        """
+        cwd = cwd or self.cwd
+        print '%s@%s %s $ %s -c ...' % (self.user, self.host, cwd, bin_python)
+        code = get_python_code(script, data)
+        command = '%s -c "%s"' % (bin_python, code)
+        # The output is not printed, like LocalHost.run_python
+        with span('run_python', 'host', host=self.host,
+                  command=bin_python) as s:
+            status, output, error = self._run(command, cwd, False)
+            s.set(status=status, bytes=len(output) + len(error))
+
+        if status:
+            # Through a shell, the error output is within the output
+            raise EnvironmentError, (status, error or output)
+        return parse_results(output)
+
+
+    def get_checksums(self, folder, names):
+        """Returns the SHA-1 checksums {name: checksum} of the given files
+        within the remote folder, computed by the remote host.  Missing files
+        are left out.
+        """
+        command = 'cd %s && sha1sum -- %s 2>/dev/null; true'
+        command = command % (quote_path(folder), ' '.join(map(quote, names)))
+        with span('checksums', 'host', host=self.host, files=len(names)):
+            channel = self.open_session()
+            with closing(channel):
+                output = read_command(channel, command)
+
+        checksums = {}
+        for line in output.splitlines():
+            checksum, name = line.split(None, 1)
+            checksums[name.lstrip('*')] = checksum
+        return checksums
+
+
     def put(self, source, target):
-        ftp = self.transport.open_sftp_client()
+        """Uploads the source file to the target path (or folder).  The file
+        is skipped if the remote copy has the same size and checksum.  Else
+        it is written to a temporary '.part' file, resumed from its current
+        size if a previous upload was interrupted, verified and renamed.
+        """
+        with span('put', 'host', host=self.host, source=source) as s:
+            s.set(bytes=self._put(source, target))
+
+
+    def _put(self, source, target):
+        # Returns the number of bytes sent
+        size = getsize(source)
+        checksum = get_checksum(source)
+
+        ftp = self.open_sftp()
         with closing(ftp) as ftp:
             target = target.replace('~', ftp.normalize('.'))
             statinfo = ftp.stat(target)
             if S_ISDIR(statinfo.st_mode):
                 target = '%s/%s' % (target, basename(source))
+            folder, name = target.rsplit('/', 1)
+            part = '%s.part' % name
+
+            # Skip if already uploaded
             try:
                 statinfo = ftp.stat(target)
             except IOError:
-                msg = 'PUT %s -> %s@%s:%s'
-                print msg % (source, self.user, self.host, target)
-                ftp.put(source, target)
+                pass
+            else:
+                if statinfo.st_size == size:
+                    checksums = self.get_checksums(folder, [name])
+                    if checksums.get(name) == checksum:
+                        print '[INFO] %s already uploaded, skipping.' % name
+                        return 0
+
+            # Resume
+            try:
+                offset = ftp.stat('%s/%s' % (folder, part)).st_size
+            except IOError:
+                offset = 0
+            if offset > size:
+                offset = 0
+
+            msg = 'PUT %s -> %s@%s:%s'
+            print msg % (source, self.user, self.host, target)
+            sent = 0
+            for offset in [offset, 0]:
+                if offset:
+                    print '[INFO] resume from byte %d' % offset
+                self._put_part(ftp, source, '%s/%s' % (folder, part), offset)
+                sent += size - offset
+                checksums = self.get_checksums(folder, [part])
+                if checksums.get(part) == checksum:
+                    break
+                if offset == 0:
+                    raise IOError, 'checksum mismatch for %s' % target
+                print '[WARNING] checksum mismatch, upload again'
+
+            # Rename
+            part = '%s/%s' % (folder, part)
+            try:
+                ftp.posix_rename(part, target)
+            except (AttributeError, IOError):
+                # posix-rename@openssh.com is not available
+                try:
+                    ftp.remove(target)
+                except IOError:
+                    pass
+                ftp.rename(part, target)
+        return sent
+
+
+    def _put_part(self, ftp, source, target, offset):
+        with open(source, 'rb') as local_file:
+            local_file.seek(offset)
+            remote_file = ftp.open(target, 'ab' if offset else 'wb')
+            with closing(remote_file):
+                remote_file.set_pipelined(True)
+                data = local_file.read(32768)
+                while data:
+                    remote_file.write(data)
+                    data = local_file.read(32768)
+
+
+    def put_many(self, sources, target):
+        """Uploads the given files to the target folder at once, through a
+        single channel.  Files already in the target folder, with the same
+        checksum, are skipped.
+
+        Like put, every file is written to a '.part' file, resumed from its
+        current size if a previous upload was interrupted, verified (by the
+        remote host) and renamed.  So retrying an interrupted upload only
+        sends the missing bytes.
+        """
+        with span('put_many', 'host', host=self.host,
+                  files=len(sources)) as s:
+            # Concurrent uploads to the same folder would append to the
+            # same '.part' files
+            with get_lock(('put', self.host, target)):
+                s.set(bytes=self._put_many(sources, target))
+
+
+    def get_upload_state(self, folder, names):
+        """Returns the SHA-1 checksums {name: checksum} of the given files
+        within the remote folder, and the size {name: bytes} of their
+        '.part' files.  Missing files are left out.
+        """
+        quoted = ' '.join(map(quote, names))
+        command = (
+            'cd %s 2>/dev/null || exit 0; sha1sum -- %s 2>/dev/null;'
+            ' for x in %s; do [ -f "$x.part" ] &&'
+            ' echo "PART $(wc -c < "$x.part") $x"; done; true')
+        command = command % (quote_path(folder), quoted, quoted)
+        with span('checksums', 'host', host=self.host, files=len(names)):
+            channel = self.open_session()
+            with closing(channel):
+                output = read_command(channel, command)
+
+        checksums = {}
+        parts = {}
+        for line in output.splitlines():
+            if line.startswith('PART '):
+                size, name = line[5:].split(None, 1)
+                parts[name] = int(size)
             else:
-                filename = basename(source)
-                print '[INFO] %s already uploaded, skipping.' % filename
+                checksum, name = line.split(None, 1)
+                checksums[name.lstrip('*')] = checksum
+        return checksums, parts
+
+
+    def _put_many(self, sources, target):
+        # Returns the number of bytes sent
+        files = {}
+        for source in sources:
+            files[basename(source)] = (getsize(source), get_checksum(source))
+
+        sent = 0
+        for attempt in [1, 2]:
+            # Skip the files already uploaded, resume the others
+            checksums, parts = self.get_upload_state(target, files.keys())
+            todo = []
+            for source in sources:
+                name = basename(source)
+                size, checksum = files[name]
+                if checksums.get(name) == checksum:
+                    if attempt == 1:
+                        print '[INFO] %s already uploaded, skipping.' % name
+                    continue
+                offset = parts.get(name, 0)
+                if offset > size:
+                    offset = 0
+                if offset:
+                    print '[INFO] %s: resume from byte %d' % (name, offset)
+                todo.append((source, offset))
+            if not todo:
+                return sent
+
+            # The remote shell appends the data of every file to its '.part'
+            # file, as it arrives.  It exits with 1 if the stream is cut
+            # (the '.part' files are kept, to resume), or with 2 if a file
+            # does not match its checksum (the '.part' file is removed).
+            print 'PUT %d files -> %s@%s:%s' % (len(todo), self.user,
+                                               self.host, target)
+            lines = ['mkdir -p %s && cd %s || exit 1' % (
+                     (quote_path(target),) * 2), 'status=0']
+            for source, offset in todo:
+                name = basename(source)
+                size, checksum = files[name]
+                part = '%s.part' % name
+                lines.append(
+                    'head -c %d %s %s; [ $(wc -c < %s) -eq %d ] || exit 1' % (
+                    size - offset, '>>' if offset else '>', quote(part),
+                    quote(part), size))
+                lines.append(
+                    'if echo %s | sha1sum -c --status; then mv -f %s %s;'
+                    ' else rm -f %s; status=2; fi' % (
+                    quote('%s  %s' % (checksum, part)), quote(part),
+                    quote(name), quote(part)))
+            lines.append('exit $status')
+
+            t0 = time()
+            channel = self.open_session()
+            with closing(channel):
+                channel.exec_command('\n'.join(lines))
+                writer = ChannelWriter(channel)
+                for source, offset in todo:
+                    with open(source, 'rb') as file:
+                        file.seek(offset)
+                        data = file.read(BUFFER_SIZE)
+                        while data:
+                            writer.write(data)
+                            data = file.read(BUFFER_SIZE)
+                channel.shutdown_write()
+                status = channel.recv_exit_status()
+                stderr = channel.makefile_stderr('rb').read()
+            seconds = time() - t0
+            sent += writer.size
+            print '[INFO] %d bytes in %.2f s (%s)' % (
+                writer.size, seconds, format_rate(writer.size, seconds))
+
+            if status == 2 and attempt == 1:
+                # Send again, in full, the files that did not match
+                print '[WARNING] checksum mismatch, upload again'
+                continue
+            if status == 2:
+                raise IOError, 'checksum mismatch uploading to %s' % target
+            if status:
+                raise EnvironmentError, (status, stderr)
+            return sent
+
 
 
 # Singleton
@@ -219,11 +729,18 @@ local = LocalHost()
 # Cache
 remote_hosts = {}
 
+# Go through the agent if it is running (see agent.py)
+use_agent = True
+
 def get_remote_host(host, user, shell):
     key = (host, user, shell)
     remote_host = remote_hosts.get(key)
     if not remote_host:
-        remote_host = RemoteHost(host, user, shell)
+        from agent import AgentHost, is_running
+        if use_agent and is_running():
+            remote_host = AgentHost(host, user, shell)
+        else:
+            remote_host = RemoteHost(host, user, shell)
         remote_hosts[key] = remote_host
 
     return remote_host
@@ -0,0 +1,157 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2009-2010 Juan David Ibáñez Palomar <jdavid@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from threading import Condition, Lock, RLock, Thread
+from traceback import format_exc
+
+
+"""
+This module provides a bounded pool of worker threads, used to run
+independent jobs (build a package, restart an instance, ...) concurrently.
+
+A job is a pair (name, callable), optionally with a group to limit how many
+jobs of the group run at once (e.g. connections to a same mirror).  Failures
+do not stop the other jobs, they are collected and reported once every job
+is done.
+"""
+
+
+
+class JobsError(Exception):
+
+    def __init__(self, failures):
+        Exception.__init__(self)
+        self.failures = failures
+
+
+    def __str__(self):
+        names = [ name for name, error, details in self.failures ]
+        return '%d job(s) failed: %s' % (len(names), ', '.join(names))
+
+
+
+def run_job(name, job, failures):
+    try:
+        job()
+    except Exception, error:
+        failures.append((name, error, format_exc()))
+
+
+
+def run_jobs(jobs, n=1, limits=None):
+    """Calls every job of the given list [(name, callable), ...], using at
+    most 'n' threads.  Returns the list of failures [(name, error, details),
+    ...], empty if every job succeeded.
+
+    A job may also be a triple (name, callable, group), then 'limits' tells
+    how many jobs of a same group may run at the same time: it is either a
+    mapping {group: limit} or a number for every group.  Jobs are started in
+    the order given, as soon as a thread and their group allow it.
+    """
+    failures = []
+
+    # Sequential
+    if n <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            run_job(job[0], job[1], failures)
+        return failures
+
+    # Concurrent
+    pending = [ (job[0], job[1], job[2] if len(job) > 2 else None)
+                for job in jobs ]
+    running = {}  # group: number of jobs running
+    condition = Condition()
+
+    def get_limit(group):
+        if group is None or limits is None:
+            return n
+        if type(limits) is int:
+            return limits
+        return limits.get(group, n)
+
+    def next_job():
+        # Called with the condition acquired
+        while pending:
+            for job in pending:
+                group = job[2]
+                if running.get(group, 0) < get_limit(group):
+                    pending.remove(job)
+                    running[group] = running.get(group, 0) + 1
+                    return job
+            condition.wait()
+        return None
+
+    def worker():
+        while True:
+            with condition:
+                job = next_job()
+            if job is None:
+                return
+            name, job, group = job
+            try:
+                run_job(name, job, failures)
+            finally:
+                with condition:
+                    running[group] -= 1
+                    condition.notify_all()
+
+    threads = []
+    for i in range(min(n, len(jobs))):
+        thread = Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    # Join with a timeout, so the main thread can be interrupted
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+
+    # Keep the order of the jobs
+    order = [ job[0] for job in jobs ]
+    failures.sort(key=lambda x: order.index(x[0]))
+    return failures
+
+
+
+def check_failures(failures):
+    """Prints the given failures and raises JobsError if there is any.
+    """
+    if not failures:
+        return
+
+    print '**********************************************************'
+    print ' ERRORS'
+    print '**********************************************************'
+    for name, error, details in failures:
+        print '[ERROR] %s' % name
+        print details
+    raise JobsError(failures)
+
+
+
+# Locks, to serialize the jobs that change a same resource
+locks = {}
+locks_lock = Lock()
+
+def get_lock(key):
+    """Returns the (re-entrant) lock associated to the given key.
+    """
+    with locks_lock:
+        lock = locks.get(key)
+        if lock is None:
+            lock = locks[key] = RLock()
+        return lock
@@ -14,9 +14,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from time import time
+
 # Import from itools
 from itools.core import freeze
 
+# Import from usine
+from jobs import check_failures, run_jobs
+from tracing import span
+
 
 class module(object):
 
@@ -28,12 +35,87 @@ class module(object):
         self.options = options.copy()
 
 
+    @classmethod
+    def get_references(cls, options):
+        """Returns the sections [(type, name), ...] the section with the
+        given options refers to.  See configuration.get_referrers
+
+        It is called for every section when the configuration is indexed,
+        so it must not fail if an option is missing: the error is raised
+        when the item is used.
+        """
+        return []
+
+
     def get_actions(self):
         return self.class_actions
 
 
     def get_action(self, name):
-        return getattr(self, 'action_%s' % name, None)
+        action = getattr(self, 'action_%s' % name, None)
+        if action is None:
+            return None
+
+        # Trace
+        def traced_action(*args, **kw):
+            with span(name, 'action', item=self.options['__name__']):
+                return action(*args, **kw)
+        return traced_action
+
+
+    def get_host_key(self):
+        """Identifies the host the actions of this item connect to, to
+        limit the number of actions run concurrently on a same host.
+        """
+        return None
+
+
+    @classmethod
+    def run_action(cls, items, name, jobs=1, jobs_per_host=None):
+        """Calls the given action on every item, running at most 'jobs'
+        of them concurrently, and 'jobs_per_host' on a same host.  Prints a
+        summary with the outcome and the elapsed time of every item.
+
+        Modules may override it to run the action on many items at once.
+        """
+        if len(items) == 1:
+            action = items[0].get_action(name)
+            action()
+            return
+
+        times = {}
+        def timed(item):
+            action = item.get_action(name)
+            def job():
+                t0 = time()
+                try:
+                    action()
+                finally:
+                    times[item.name] = time() - t0
+            return job
+
+        jobs_list = [ (x.name, timed(x), x.get_host_key()) for x in items ]
+        failures = run_jobs(jobs_list, jobs, jobs_per_host)
+
+        failed = set([ x[0] for x in failures ])
+        print_summary(name, items, failed, times)
+        check_failures(failures)
+
+
+
+def print_summary(name, items, failed, times):
+    """Prints the outcome of the given action on every item, and its
+    elapsed time {item name: seconds}.  'failed' is the set of the names of
+    the items that failed.
+    """
+    print '**********************************************************'
+    print ' SUMMARY (%s)' % name
+    print '**********************************************************'
+    width = max([ len(x.name) for x in items ])
+    for item in items:
+        status = '[ERROR]' if item.name in failed else '[OK]   '
+        print '%s %s %6.1f s' % (status, item.name.ljust(width),
+                                 times.get(item.name, 0.0))
 
 
 
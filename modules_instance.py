@@ -15,47 +15,187 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
-from os.path import expanduser
-
-# Import from pygobject
-from glib import GError
+from functools import partial
+from json import dumps
+from os import makedirs
+from os.path import basename, exists, expanduser
+from re import sub
+from time import time
 
 # Import from itools
 from itools.core import freeze, lazy
-from itools.fs import lfs, vfs
 
 # Import from usine
+from cache import get_value, set_value
 from config import config
-from hosts import local, get_remote_host
-from modules import module, register_module
+from hosts import local, get_checksum, get_remote_host
+from jobs import run_jobs, check_failures
+from modules import module, print_summary, register_module
+from modules_source import sync_sources
+from planner import Plan
+from tracing import add_span, span
+
+
+
+# Returns the vhosts of the given ikaaro instances, whose catalog has changed
+# since the given modification time (run by the Python interpreter of the
+# pyenv, see hosts.get_python_code).  The modification time of the catalog
+# folder is enough: every commit of the Xapian database renames a new
+# version (or base) file into place, which changes the folder.
+script_vhosts = """
+import os, sys
+result = {}
+for path, mtime in data['instances']:
+    catalog = os.path.join(os.path.expanduser(path), 'catalog')
+    last = os.stat(catalog).st_mtime
+    if last == mtime:
+        result[path] = {'mtime': last}
+        continue
+    from itools.database import Catalog, get_register_fields
+    catalog = Catalog(catalog, get_register_fields(), read_only=True)
+    vhosts = sorted(catalog.get_unique_values('vhosts'))
+    result[path] = {'mtime': last, 'vhosts': vhosts}
+sys.stdout.write(RESULT + json.dumps(result) + '\\n')
+"""
 
 
+# Returns the build (checksum) of the packages installed by usine, and the
+# version of every distribution found by pkg_resources (run by the Python
+# interpreter of the pyenv, see hosts.get_python_code)
+script_installed = """
+import os, re, sys
+record = {}
+path = os.path.expanduser(data['record'])
+if os.path.exists(path):
+    record = json.loads(open(path).read())
+versions = {}
+try:
+    import pkg_resources
+except ImportError:
+    pass
+else:
+    for dist in pkg_resources.working_set:
+        name = re.sub('[^A-Za-z0-9.]+', '-', dist.project_name).lower()
+        versions[name] = dist.version
+result = {'record': record, 'versions': versions}
+sys.stdout.write(RESULT + json.dumps(result) + '\\n')
+"""
+
+
+# Returns the number of CPUs of the host and the size of the catalog of the
+# given ikaaro instances (run by the Python interpreter of the pyenv, see
+# hosts.get_python_code)
+script_catalogs = """
+import os, sys
+try:
+    from multiprocessing import cpu_count
+    cpus = cpu_count()
+except (ImportError, NotImplementedError):
+    cpus = 1
+sizes = {}
+for path in data['paths']:
+    size = 0
+    catalog = os.path.join(os.path.expanduser(path), 'catalog')
+    for root, folders, files in os.walk(catalog):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    sizes[path] = size
+result = {'cpus': cpus, 'sizes': sizes}
+sys.stdout.write(RESULT + json.dumps(result) + '\\n')
+"""
+
 
-cmd_vhosts = """
-from itools.database import Catalog, get_register_fields
-catalog = Catalog('./%s/catalog', get_register_fields(), read_only=True)
-vhosts = list(catalog.get_unique_values('vhosts'))
-vhosts.sort()
-for vhost in vhosts:
-    print vhost
+# Installs the given source distributions or wheels, and records their build
+# (run by the Python interpreter of the pyenv, see hosts.get_python_code)
+script_install = """
+import os, shutil, subprocess, sys, tarfile, tempfile, time
+prefix = data['prefix'] and os.path.expanduser(data['prefix'])
+command = [sys.executable, 'setup.py', '--quiet', 'install', '--force']
+if prefix:
+    command.append('--prefix=%s' % prefix)
+# Wheels are installed as they are: no build, no byte-compile
+command_wheel = [sys.executable, '-m', 'pip', 'install', '--quiet',
+                 '--no-deps', '--no-index', '--force-reinstall',
+                 '--no-compile']
+if prefix:
+    command_wheel.extend(['--prefix', prefix])
+record_path = os.path.expanduser(data['record'])
+record = {}
+if os.path.exists(record_path):
+    record = json.loads(open(record_path).read())
+for package in data['packages']:
+    t0 = time.time()
+    pkgname = package['name']
+    path = os.path.expanduser(package['path'])
+    folder = tempfile.mkdtemp()
+    try:
+        if path.endswith('.whl'):
+            args, cwd = command_wheel + [path], folder
+        else:
+            tar = tarfile.open(path)
+            tar.extractall(folder)
+            tar.close()
+            args, cwd = command, os.path.join(folder, pkgname)
+        popen = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+        output = popen.communicate()[0]
+        status = popen.returncode
+    except Exception:
+        output = str(sys.exc_info()[1])
+        status = -1
+    shutil.rmtree(folder, True)
+    if status:
+        sys.stdout.write(output)
+    else:
+        record[pkgname] = package['checksum']
+        tmp = '%s.tmp' % record_path
+        open(tmp, 'w').write(json.dumps(record))
+        os.rename(tmp, record_path)
+    result = {'name': pkgname, 'status': status, 'time': time.time() - t0}
+    sys.stdout.write(RESULT + json.dumps(result) + '\\n')
+    sys.stdout.flush()
 """
 
 
+
+def get_batch_size(batch, n):
+    """Returns the number of instances, out of n, to restart at once.  The
+    batch is either a number or a percentage (e.g. '25%').  Unless there is
+    a single instance, at least one is left serving.
+    """
+    if batch.endswith('%'):
+        size = n * int(batch[:-1]) // 100
+    else:
+        size = int(batch)
+    size = max(size, 1)
+    if n > 1:
+        size = min(size, n - 1)
+    return size
+
+
+
+def parse_location(location):
+    """Returns the user, the server and the path of the given location,
+    either 'localhost:<path>' or '<user>@<server>:<path>'.
+    """
+    if location[:10] == 'localhost:':
+        # Case 1: local
+        user, server, path = None, 'localhost', location[10:]
+    else:
+        # Case 2: remote
+        user, location = location.split('@', 1)
+        server, path = location.split(':', 1)
+    if path[0] != '/':
+        path = '~/%s' % path
+    return user, server, path
+
+
+
 class instance(module):
 
     @lazy
     def location(self):
-        location = self.options['location']
-        if location[:10] == 'localhost:':
-            # Case 1: local
-            user, server, path = None, 'localhost', location[10:]
-        else:
-            # Case 2: remote
-            user, location = location.split('@', 1)
-            server, path = location.split(':', 1)
-        if path[0] != '/':
-            path = '~/%s' % path
-        return user, server, path
+        return parse_location(self.options['location'])
 
 
     @lazy
@@ -78,6 +218,10 @@ class instance(module):
         return get_remote_host(host, user, shell)
 
 
+    def get_host_key(self):
+        return self.location[1]
+
+
     def get_source(self, name):
         source = config.get_section('pysrc', name)
         if source:
@@ -92,19 +236,32 @@ class pyenv(instance):
     class_title = u'Manage Python environments'
 
 
+    @classmethod
+    def get_references(cls, options):
+        references = [ ('pysrc', x.split(':')[0])
+                       for x in options.get('packages', '').split() ]
+        try:
+            server = parse_location(options['location'])[1]
+        except (KeyError, IndexError, ValueError):
+            # Missing or malformed, the error is raised when used
+            return references
+        if server != 'localhost':
+            references.append(('server', server))
+        return references
+
+
     def get_actions(self):
         if self.location[1] == 'localhost':
             return ['build', 'install', 'restart', 'deploy', 'deploy_reindex',
-                    'reindex']
+                    'deploy_reindex_online', 'reindex', 'reindex_online']
         return ['build', 'upload', 'install', 'restart', 'deploy',
-                'deploy_reindex', 'test', 'vhosts', 'reindex']
+                'deploy_reindex', 'deploy_reindex_online', 'test', 'vhosts',
+                'reindex', 'reindex_online']
 
 
     def get_action(self, name):
         if self.location[1] == 'localhost':
-            if name == 'install':
-                return self.action_install_local
-            elif name == 'upload':
+            if name == 'upload':
                 return None
         return super(pyenv, self).get_action(name)
 
@@ -114,21 +271,127 @@ class pyenv(instance):
         return [ x.split(':') for x in packages ]
 
 
+    @lazy
+    def record_path(self):
+        """The file, within the Python environment, where the build of the
+        packages installed is recorded.
+        """
+        return '%s/.usine-installed.json' % self.location[2]
+
+
+    # The record and the versions of the packages installed, see
+    # get_installed
+    installed = None
+
+    def get_installed(self):
+        """Returns the build of the packages installed by usine {pkgname:
+        checksum}, and the version of every distribution {name: version},
+        with a single query to the host.
+        """
+        if self.installed is None:
+            host = self.get_host()
+            data = {'record': self.record_path}
+            result = host.run_python(self.bin_python, script_installed, data,
+                                     self.location[2])
+            record = result[0]['record'] if result else {}
+            versions = result[0]['versions'] if result else {}
+            self.installed = record, versions
+        return self.installed
+
+
+    def is_installed(self, pkgname, checksum):
+        record, versions = self.get_installed()
+        if record.get(pkgname) != checksum:
+            return False
+        # Changed since usine installed it
+        name, version = pkgname.rsplit('-', 1)
+        name = sub('[^A-Za-z0-9.]+', '-', name).lower()
+        return versions.get(name, version) == version
+
+
+    # The packages not installed yet, see get_outdated_packages
+    outdated = None
+
+    # Whether the last deploy installed something, see install_packages
+    deployed = False
+
+    def get_outdated_packages(self):
+        """Returns the packages [(pkgname, sdist, checksum), ...] whose
+        build is not installed in the Python environment, with a single
+        query to the host.  Packages must be built first.
+        """
+        if self.outdated is not None:
+            return self.outdated
+
+        self.outdated = []
+        for name, version in self.get_packages():
+            package = self.get_package(name, version)
+            if self.is_installed(package[0], package[2]):
+                print '[INFO] %s already installed, skipping.' % package[0]
+            else:
+                self.outdated.append(package)
+        return self.outdated
+
+
+    def get_build_python(self):
+        """Returns the local Python interpreter to build wheels for this
+        environment (the 'build_python' option), or None to install from
+        the source distributions.  It must have the same version, ABI and
+        platform as the Python interpreter of the environment.
+        """
+        python = self.options.get('build_python')
+        if python:
+            return expanduser(python)
+        return None
+
+
+    def get_package(self, name, version):
+        """Returns the package (pkgname, path, checksum) built from the
+        given source and version: its wheel if the environment has a build
+        Python, else its source distribution.
+        """
+        source = self.get_source(name)
+        python = self.get_build_python()
+        if python:
+            path = source.get_wheel(version, python)
+        else:
+            path = source.get_sdist(version)
+        if path is None:
+            raise ValueError, 'the source "%s" is not built' % name
+        return source.get_pkgname(version), path, get_checksum(path)
+
+
     build_title = u'Build the source code this Python environment requires'
     def action_build(self):
-        """Make a source distribution for every required Python package.
+        """Make a source distribution for every required Python package,
+        and a wheel if the environment has a build Python (see
+        get_build_python).
         """
         path = expanduser('~/.usine/cache')
-        if not lfs.exists(path):
-            lfs.make_folder(path)
+        if not exists(path):
+            makedirs(path)
 
         print '**********************************************************'
         print ' BUILD'
         print '**********************************************************'
-        for name, version in self.get_packages():
-            config.options.version = version
-            source = self.get_source(name)
-            source.action_dist()
+        packages = [ (self.get_source(name), version)
+                     for name, version in self.get_packages() ]
+        sync_sources([ source for source, version in packages ])
+
+        jobs = []
+        for source, version in packages:
+            job = partial(self.build_package, source, version)
+            jobs.append(('%s:%s' % (source.name, version), job))
+
+        failures = run_jobs(jobs, config.options.jobs)
+        check_failures(failures)
+
+
+    def build_package(self, source, version):
+        source.get_action('dist')(version, sync=False)
+        python = self.get_build_python()
+        if python:
+            source.build_wheel(version, python)
 
 
     upload_title = u'Upload the source code to the remote server'
@@ -139,62 +402,94 @@ class pyenv(instance):
         print '**********************************************************'
         print ' UPLOAD'
         print '**********************************************************'
-        for name, version in self.get_packages():
-            source = self.get_source(name)
-            # Upload
-            pkgname = source.get_pkgname()
-            l_path = '%s/dist/%s.tar.gz' % (source.get_path(), pkgname)
-            host.put(l_path, '/tmp')
+        sources = [ sdist for pkgname, sdist, checksum
+                    in self.get_outdated_packages() ]
+        if sources:
+            host.put_many(sources, '/tmp')
 
 
     install_title = u'Install the source code into the Python environment'
     def action_install(self):
-        """Installs every required package into the remote virtual
-        environment.
+        """Installs every required package, not installed yet, into the
+        virtual environment.
         """
-        host = self.get_host()
         print '**********************************************************'
         print ' INSTALL'
         print '**********************************************************'
-        command = '%s setup.py --quiet install --force' % self.bin_python
-        prefix = self.options.get('prefix')
-        if prefix:
-            command += ' --prefix=%s' % prefix
-        for name, version in self.get_packages():
-            source = self.get_source(name)
-            pkgname = source.get_pkgname()
-            # Untar
-            host.run('tar xzf %s.tar.gz' % pkgname, '/tmp')
-            pkg_path = '/tmp/%s' % pkgname
-            # Install
-            host.run(command, pkg_path)
-            # Clean
-            host.run('rm -rf %s' % pkg_path, '/tmp')
-
-
-    def action_install_local(self):
-        print '**********************************************************'
-        print ' INSTALL'
-        print '**********************************************************'
-        bin_python = expanduser(self.bin_python)
-        command = [bin_python, 'setup.py', 'install', '--force']
-        for name, version in self.get_packages():
-            source = self.get_source(name)
-            cwd = source.get_path()
-            local.run(command, cwd=cwd)
+        self.install(self.get_outdated_packages())
+
+
+    def install(self, outdated):
+        """Installs the given packages [(pkgname, sdist, checksum), ...],
+        uploaded first if the host is remote, with a single command.
+        """
+        host = self.get_host()
+        packages = []
+        for pkgname, sdist, checksum in outdated:
+            if host is not local:
+                # Uploaded
+                sdist = '/tmp/%s' % basename(sdist)
+            packages.append(
+                {'name': pkgname, 'path': sdist, 'checksum': checksum})
+        if not packages:
+            return
+
+        # Install every package with a single command
+        data = {'packages': packages, 'record': self.record_path,
+                'prefix': self.options.get('prefix')}
+        results = host.run_python(self.bin_python, script_install, data,
+                                  '/tmp')
+        self.outdated = None
+        self.installed = None
+
+        # Trace, the packages are installed one after the other
+        start = time() - sum([ x['time'] for x in results ])
+        for result in results:
+            end = start + result['time']
+            add_span(result['name'], 'package', start, end,
+                     status=result['status'])
+            start = end
+
+        # Report
+        failures = []
+        for result in results:
+            name = result['name']
+            if result['status'] == 0:
+                print '[OK] %s (%.1f s)' % (name, result['time'])
+            else:
+                print '[ERROR] %s (%.1f s)' % (name, result['time'])
+                details = 'exit status %s' % result['status']
+                failures.append((name, None, details))
+        installed = [ x['name'] for x in results ]
+        for package in packages:
+            name = package['name']
+            if name not in installed:
+                print '[ERROR] %s (not installed)' % name
+                failures.append((name, None, 'not installed'))
+        check_failures(failures)
+
+
+    def get_ikaaros(self):
+        return config.get_referrers('pyenv', self.name, 'ikaaro')
 
 
     restart_title = u'Restart the ikaaro instances that use this environment'
     def action_restart(self):
-        """Restarts every ikaaro instance.
+        """Restarts every ikaaro instance, by batches (see the --batch
+        option).  The instances of a batch are restarted concurrently, and
+        the next batch waits for them to be ready.
         """
         print '**********************************************************'
         print ' RESTART'
         print '**********************************************************'
-        for ikaaro in config.get_sections_by_type('ikaaro'):
-            if ikaaro.options['pyenv'] == self.name:
-                ikaaro.stop()
-                ikaaro.start()
+        ikaaros = self.get_ikaaros()
+        size = get_batch_size(config.options.batch, len(ikaaros))
+        for i in range(0, len(ikaaros), size):
+            batch = ikaaros[i:i+size]
+            jobs = [ (x.name, x.restart) for x in batch ]
+            failures = run_jobs(jobs, size)
+            # Stop rolling if a batch fails
+            check_failures(failures)
 
 
     reindex_title = u'Reindex the ikaaro instances that use this environment'
@@ -204,24 +499,68 @@ class pyenv(instance):
         print '**********************************************************'
         print ' REINDEX'
         print '**********************************************************'
-        for ikaaro in config.get_sections_by_type('ikaaro'):
-            if ikaaro.options['pyenv'] == self.name:
-                ikaaro.stop()
-                ikaaro.update_catalog()
-                ikaaro.start()
+        self.reindex()
+
+
+    reindex_online_title = (
+        u'Reindex the ikaaro instances, serving read-only meanwhile')
+    def action_reindex_online(self):
+        """Reindex every ikaaro instance, see ikaaro.reindex_online.
+        """
+        print '**********************************************************'
+        print ' REINDEX (ONLINE)'
+        print '**********************************************************'
+        self.reindex(online=True)
+
+
+    def reindex(self, online=False):
+        """As many instances as the host has CPUs (or --jobs, if given)
+        are reindexed concurrently, the largest catalogs first, and every
+        instance is started again as soon as its own reindex is done.
+        """
+        ikaaros = self.get_ikaaros()
+        if not ikaaros:
+            return
+
+        ikaaros, n = self.get_reindex_order(ikaaros)
+        jobs = [ (x.name, partial(x.reindex, online)) for x in ikaaros ]
+        failures = run_jobs(jobs, n)
+        check_failures(failures)
+
+
+    def get_reindex_order(self, ikaaros, cached=False):
+        """Returns the given ikaaro instances, the largest catalogs first,
+        and how many to reindex at once: as many as the host has CPUs (or
+        --jobs, if given).  With a single query to the host; or, if
+        'cached' is true, from the answer to the last query (if there is
+        none, the order is kept and the host is taken to have one CPU).
+        """
+        key = self.options['location']
+        if cached:
+            result = get_value('catalogs', key)
+        else:
+            host = self.get_host()
+            data = {'paths': [ x.options['path'] for x in ikaaros ]}
+            result = host.run_python(self.bin_python, script_catalogs, data,
+                                     self.location[2])
+            result = result[0] if result else None
+            set_value('catalogs', key, result)
+        cpus = result['cpus'] if result else 1
+        sizes = result['sizes'] if result else {}
+
+        n = config.options.jobs if config.options.jobs > 1 else cpus
+        key = lambda x: sizes.get(x.options['path'], 0)
+        ikaaros = sorted(ikaaros, key=key, reverse=True)
+        return ikaaros, n
 
 
     deploy_title = u'All of the above'
     def action_deploy(self):
         """Deploy (build, upload, install, restart) the required Python
         packages in the remote virtual environment, and restart all the ikaaro
-        instances.
+        instances.  See make_deploy_plan.
         """
-        actions = ['build', 'upload', 'install', 'restart']
-        for name in actions:
-            action = self.get_action(name)
-            if action:
-                action()
+        deploy([self])
 
 
     deploy_reindex_title = (
@@ -230,31 +569,120 @@ class pyenv(instance):
         """
         Build, upload, install the required Python packages
         in the remote virtual environment and stop, reindex and start all the
-        ikaaro instances.
+        ikaaro instances.  See make_deploy_plan.
         """
-        actions = ['build', 'upload', 'install', 'stop', 'reindex', 'start']
-        for name in actions:
-            action = self.get_action(name)
-            if action:
-                action()
+        deploy([self], reindex=True)
+
+
+    deploy_reindex_online_title = (
+        u'Build, upload, install and reindex, serving read-only meanwhile')
+    def action_deploy_reindex_online(self):
+        """Like deploy_reindex, but the ikaaro instances serve in read-only
+        mode while reindexed (see ikaaro.reindex_online).
+        """
+        deploy([self], reindex=True, online=True)
+
+
+    @classmethod
+    def run_action(cls, items, name, jobs=1, jobs_per_host=None):
+        # A single plan for every item, so the packages they share are
+        # built once
+        if name == 'deploy':
+            return deploy(items)
+        elif name == 'deploy_reindex':
+            return deploy(items, reindex=True)
+        elif name == 'deploy_reindex_online':
+            return deploy(items, reindex=True, online=True)
+        return super(pyenv, cls).run_action(items, name, jobs, jobs_per_host)
 
 
     test_title = (
         u'Test if ikaaro instances of this Python environment are alive')
     def action_test(self):
-        """ Test if ikaaro instances of this Python environment are alive"""
+        """Test if ikaaro instances of this Python environment are alive.
+        Every instance is probed --samples times, concurrently, and the
+        latency percentiles are reported; also as JSON with --json.
+        """
         print '**********************************************************'
         print ' TEST'
         print '**********************************************************'
-        for ikaaro in config.get_sections_by_type('ikaaro'):
-            if ikaaro.options['pyenv'] == self.name:
-                uri = ikaaro.options['uri']
-                try:
-                    vfs.open('%s/;_ctrl' % uri)
-                except GError:
-                    print '[ERROR] ', uri
-                else:
-                    print '[OK]', uri
+        # Loading httplib is slow, only do it when needed
+        from probes import check
+        uris = [ x.options['uri'] for x in self.get_ikaaros() ]
+        samples = config.options.samples
+        report = check(uris, samples)
+
+        # Human
+        def format_ms(value):
+            return '%7.1f' % value if value is not None else '      -'
+        print '        %s  p50 ms  p90 ms  p99 ms  max ms' % 'ok'.rjust(5)
+        for uri in uris:
+            probes = report[uri]
+            if probes['errors'] == 0:
+                status = '[OK]   '
+            elif probes['ok'] == 0:
+                status = '[ERROR]'
+            else:
+                status = '[WARN] '
+            latencies = [ format_ms(probes[x])
+                          for x in ['p50', 'p90', 'p99', 'max'] ]
+            print '%s %2d/%-2d %s %s' % (status, probes['ok'], samples,
+                                        ' '.join(latencies), uri)
+            if 'error' in probes:
+                print '        %s' % probes['error']
+
+        # Machine
+        path = config.options.json
+        if path:
+            data = dumps({'pyenv': self.name, 'samples': samples,
+                          'instances': report})
+            if path == '-':
+                print data
+            else:
+                with open(path, 'w') as file:
+                    file.write(data + '\n')
+
+
+    def get_vhosts(self, ikaaros=None):
+        """Returns the vhosts {name: [vhost, ...]} of the given ikaaro
+        instances (default: all of this environment), with a single query to
+        the host.  The vhosts are cached by the modification time of the
+        catalog folder, so only the catalogs that changed are opened.
+
+        Every call still costs a round-trip and a Python interpreter on the
+        host, plus a stat of every catalog folder.
+        """
+        if ikaaros is None:
+            ikaaros = self.get_ikaaros()
+        if not ikaaros:
+            return {}
+
+        location = self.options['location']
+        cached = {}
+        for ikaaro in ikaaros:
+            path = ikaaro.options['path']
+            key = '%s %s' % (location, path)
+            cached[path] = get_value('vhosts', key, {})
+
+        # Query
+        host = self.get_host()
+        data = {'instances': [ (path, cached[path].get('mtime'))
+                               for path in sorted(cached) ]}
+        result = host.run_python(self.bin_python, script_vhosts, data,
+                                 self.location[2])
+        result = result[0] if result else {}
+
+        vhosts = {}
+        for ikaaro in ikaaros:
+            path = ikaaro.options['path']
+            value = result.get(path, {})
+            if 'vhosts' in value:
+                key = '%s %s' % (location, path)
+                set_value('vhosts', key, value)
+            else:
+                value = cached[path]
+            vhosts[ikaaro.name] = value.get('vhosts', [])
+        return vhosts
 
 
     vhosts_title = (
@@ -264,16 +692,25 @@ class pyenv(instance):
         print '**********************************************************'
         print ' LIST VHOSTS'
         print '**********************************************************'
-        for ikaaro in config.get_sections_by_type('ikaaro'):
-            if ikaaro.options['pyenv'] == self.name:
-                ikaaro.vhosts()
+        ikaaros = self.get_ikaaros()
+        vhosts = self.get_vhosts(ikaaros)
+        for ikaaro in ikaaros:
+            for vhost in vhosts[ikaaro.name]:
+                print vhost
 
 
 
 class ikaaro(instance):
 
     class_title = u'Manage Ikaaro instances'
-    class_actions = freeze(['start', 'stop', 'restart', 'reindex', 'vhosts'])
+    class_actions = freeze(['start', 'stop', 'restart', 'reindex',
+                            'reindex_online', 'vhosts'])
+
+
+    @classmethod
+    def get_references(cls, options):
+        pyenv = options.get('pyenv')
+        return [('pyenv', pyenv)] if pyenv else []
 
 
     @lazy
@@ -289,19 +726,32 @@ class ikaaro(instance):
         return '%s/bin' % prefix
 
 
+    @lazy
+    def cwd(self):
+        # Commands run from the folder of the Python environment
+        return self.pyenv.location[2]
+
+
     def get_host(self):
-        pyenv = self.pyenv
-        host = pyenv.get_host()
-        cwd = pyenv.location[2]
-        host.chdir(cwd)
+        host = self.pyenv.get_host()
+        host.chdir(self.cwd)
         return host
 
 
+    def get_host_key(self):
+        return self.pyenv.get_host_key()
+
+
     def stop(self):
         path = self.options['path']
         host = self.get_host()
-        host.run('%s/icms-stop.py %s' % (self.bin_icms, path))
-        host.run('%s/icms-stop.py --force %s' % (self.bin_icms, path))
+        for option in ['', '--force ']:
+            # The instance may not be running
+            try:
+                host.run('%s/icms-stop.py %s%s' % (self.bin_icms, option,
+                                                  path), self.cwd)
+            except EnvironmentError, error:
+                print '[WARNING] %s' % error
 
 
     def start(self, readonly=False):
@@ -311,21 +761,107 @@ class ikaaro(instance):
         if readonly:
             cmd = cmd + ' -r'
         host = self.get_host()
-        host.run(cmd)
+        host.run(cmd, self.cwd)
 
 
-    def update_catalog(self):
+    def wait_ready(self):
+        """Waits for the instance to answer on its 'uri' (if any), for at
+        most --timeout seconds.
+        """
+        uri = self.options.get('uri')
+        if not uri:
+            return
+        from probes import wait_ready
+        timeout = config.options.timeout
+        seconds = wait_ready(uri, timeout)
+        if seconds is None:
+            msg = '%s not ready after %s seconds' % (uri, timeout)
+            raise EnvironmentError, (None, msg)
+        print '[OK] %s ready in %.1f s' % (uri, seconds)
+
+
+    def restart(self):
+        with span('restart', 'instance', item=self.name):
+            self.stop()
+            self.start()
+            self.wait_ready()
+
+
+    def reindex(self, online=False):
+        with span('reindex', 'instance', item=self.name, online=online):
+            if online:
+                return self.reindex_online()
+
+            self.stop()
+            self.update_catalog()
+            self.start()
+
+
+    def reindex_online(self):
+        """Rebuilds the catalog while the instance serves in read-only
+        mode, then swaps it in.  The instance is only down while swapping.
+
+        The new catalog is built in a side instance (<path>.reindex) made of
+        links to everything in the instance but its catalog and pid files.
+
+        Whatever fails, the instance is started again read-write (with its
+        old catalog, unless the swap is done) and the side instance is
+        removed.
+        """
         path = self.options['path']
+        side = '%s.reindex' % path
+        host = self.get_host()
+
+        # Serve read-only
+        self.stop()
+        stopped = False
+        try:
+            self.start(readonly=True)
+            self.wait_ready()
+
+            # Build the new catalog
+            cmd = (
+                'rm -rf {1} && mkdir {1} && for x in $(ls {0}); do'
+                ' case $x in catalog|pid*) ;;'
+                ' *) ln -s $(cd {0} && pwd)/$x {1}/$x ;; esac; done')
+            host.run(cmd.format(path, side), self.cwd)
+            self.update_catalog(side)
+
+            # Swap, put the old catalog back if the new one cannot be moved
+            self.stop()
+            stopped = True
+            host.run('mv {0}/catalog {0}/catalog.old'.format(path), self.cwd)
+            try:
+                cmd = 'mv {1}/catalog {0}/catalog'.format(path, side)
+                host.run(cmd, self.cwd)
+            except EnvironmentError:
+                cmd = 'mv {0}/catalog.old {0}/catalog'.format(path)
+                host.run(cmd, self.cwd)
+                raise
+        finally:
+            # Serve read-write
+            try:
+                if not stopped:
+                    self.stop()
+                self.start()
+            finally:
+                host.run('rm -rf {0}'.format(side), self.cwd)
+
+        self.wait_ready()
+        host.run('rm -rf {0}/catalog.old'.format(path), self.cwd)
+
+
+    def update_catalog(self, path=None):
+        path = path or self.options['path']
         cmd = '{0}/icms-update-catalog.py -y {1} --quiet'.format(self.bin_icms, path)
         host = self.get_host()
-        host.run(cmd)
+        host.run(cmd, self.cwd)
 
 
     def vhosts(self):
-        path = self.options['path']
-        host = self.get_host()
-        cmd = cmd_vhosts % path
-        host.run('./bin/python -c "%s"' % cmd, quiet=True)
+        vhosts = self.pyenv.get_vhosts([self])
+        for vhost in vhosts[self.name]:
+            print vhost
 
 
     start_title = u'Start an ikaaro instance'
@@ -349,8 +885,7 @@ class ikaaro(instance):
         print '**********************************************************'
         print ' RESTART'
         print '**********************************************************'
-        self.stop()
-        self.start()
+        self.restart()
 
 
     reindex_title = u'Update catalog of an ikaaro instance'
@@ -358,9 +893,16 @@ class ikaaro(instance):
         print '**********************************************************'
         print ' REINDEX'
         print '**********************************************************'
-        self.stop()
-        self.update_catalog()
-        self.start()
+        self.reindex()
+
+
+    reindex_online_title = (
+        u'Update catalog of an ikaaro instance, serving read-only meanwhile')
+    def action_reindex_online(self):
+        print '**********************************************************'
+        print ' REINDEX (ONLINE)'
+        print '**********************************************************'
+        self.reindex(online=True)
 
 
     vhosts_title = u'List vhosts of ikaaro instance'
@@ -372,6 +914,231 @@ class ikaaro(instance):
 
 
 
+###########################################################################
+# Deploy
+###########################################################################
+def upload_packages(pyenvs):
+    """Uploads the packages the given environments, on a same host, do not
+    have installed yet, with a single stream (see RemoteHost.put_many).
+    """
+    sources = []
+    for pyenv in pyenvs:
+        for pkgname, path, checksum in pyenv.get_outdated_packages():
+            if path not in sources:
+                sources.append(path)
+    if sources:
+        pyenvs[0].get_host().put_many(sources, '/tmp')
+
+
+
+def install_packages(pyenv):
+    outdated = pyenv.get_outdated_packages()
+    if not outdated:
+        print '[INFO] %s: nothing to deploy' % pyenv.name
+    # Restart the instances only if something changed
+    pyenv.deployed = bool(outdated)
+    pyenv.install(outdated)
+
+
+
+def restart_instance(pyenv, ikaaro):
+    if pyenv.deployed:
+        ikaaro.restart()
+
+
+
+def make_deploy_plan(pyenvs, reindex=False, online=False):
+    """Returns the plan (see planner.py) to deploy the given Python
+    environments, the limits of its groups of tasks (see Plan.run), and the
+    tasks of every environment {name: [task, ...]}:
+
+    - sync every source, and build every version required, once even if
+      many environments require it; and its wheel, once for every build
+      Python (see pyenv.get_build_python)
+    - query the packages installed in every environment
+    - upload the packages every remote host needs with a single stream,
+      once they are built and every environment of the host is queried
+    - install the packages of every environment with a single command
+    - restart the ikaaro instances by batches (see the --batch option), if
+      something was installed; or reindex them (then always), online if
+      asked, the largest catalogs first and as many at once on a same host
+      as it has CPUs (see pyenv.get_reindex_order)
+
+    The tasks that run commands on a host (but the reindexes) are at most
+    --jobs-per-host at once on a same host.
+
+    The size of the catalogs is queried while planning; but with the
+    --dry-run option, the answer to the last query is used, the hosts are
+    not contacted.
+    """
+    plan = Plan()
+    jobs = max(config.options.jobs, 1)
+    jobs_per_host = max(config.options.jobs_per_host or jobs, 1)
+    limits = {None: jobs}
+    tasks = dict([ (x.name, []) for x in pyenvs ])
+
+    def get_host_group(pyenv):
+        group = ('host', pyenv.get_host_key())
+        limits[group] = min(jobs_per_host, jobs)
+        return group
+
+    # Build
+    builds = {}
+    for pyenv in pyenvs:
+        for name, version in pyenv.get_packages():
+            if (name, version) in builds:
+                continue
+            source = pyenv.get_source(name)
+            deps = []
+            sync = source.get_action('sync')
+            if sync:
+                task = 'sync %s' % name
+                if task not in plan.by_name:
+                    mirror = source.get_mirror()
+                    group = ('mirror', mirror.name)
+                    limit = int(mirror.options.get('jobs', 4))
+                    limits[group] = max(min(limit, jobs), 1)
+                    plan.add(task, sync, group=group)
+                deps.append(task)
+            job = partial(source.get_action('dist'), version, sync=False)
+            task = plan.add('build %s:%s' % (name, version), job, deps)
+            builds[(name, version)] = task
+
+    # Wheels, once for every build Python
+    for pyenv in pyenvs:
+        python = pyenv.get_build_python()
+        if python is None:
+            continue
+        for name, version in pyenv.get_packages():
+            if (name, version, python) in builds:
+                continue
+            source = pyenv.get_source(name)
+            job = partial(source.build_wheel, version, python)
+            task = 'wheel %s:%s %s' % (name, version, python)
+            task = plan.add(task, job, [builds[(name, version)]])
+            builds[(name, version, python)] = task
+
+    # Query, and what every environment needs built
+    queries = {}
+    needs = {}
+    for pyenv in pyenvs:
+        queries[pyenv.name] = plan.add('query %s' % pyenv.name,
+                                       pyenv.get_installed,
+                                       group=get_host_group(pyenv))
+        python = pyenv.get_build_python()
+        needs[pyenv.name] = []
+        for name, version in pyenv.get_packages():
+            build = builds[(name, version)]
+            wheel = builds.get((name, version, python))
+            for task in plan.by_name[build].deps + [build, wheel]:
+                if task and task not in tasks[pyenv.name]:
+                    tasks[pyenv.name].append(task)
+            needs[pyenv.name].append(wheel or build)
+
+    # Upload, once for every remote host
+    by_host = {}
+    for pyenv in pyenvs:
+        if pyenv.location[1] != 'localhost':
+            by_host.setdefault(pyenv.get_host_key(), []).append(pyenv)
+    uploads = {}
+    for pyenv in pyenvs:
+        key = pyenv.get_host_key()
+        if key not in by_host or key in uploads:
+            continue
+        deps = []
+        for x in by_host[key]:
+            deps.extend([ y for y in needs[x.name] if y not in deps ])
+            deps.append(queries[x.name])
+        job = partial(upload_packages, by_host[key])
+        uploads[key] = plan.add('upload %s' % key, job, deps,
+                                get_host_group(pyenv))
+
+    for pyenv in pyenvs:
+        # Install
+        query = queries[pyenv.name]
+        upload = uploads.get(pyenv.get_host_key())
+        deps = [upload] if upload else needs[pyenv.name]
+        install = plan.add('install %s' % pyenv.name,
+                           partial(install_packages, pyenv), deps + [query],
+                           get_host_group(pyenv))
+        tasks[pyenv.name].extend(
+            [query] + ([upload] if upload else []) + [install])
+
+        # Reindex
+        ikaaros = pyenv.get_ikaaros()
+        if reindex:
+            if not ikaaros:
+                continue
+            dry_run = config.options.dry_run
+            ikaaros, n = pyenv.get_reindex_order(ikaaros, cached=dry_run)
+            if config.options.jobs_per_host:
+                n = min(n, config.options.jobs_per_host)
+            group = ('reindex', pyenv.get_host_key())
+            limits[group] = max(min(n, limits.get(group, n)), 1)
+            for ikaaro in ikaaros:
+                job = partial(ikaaro.reindex, online)
+                task = plan.add('reindex %s' % ikaaro.name, job, [install],
+                                group)
+                tasks[pyenv.name].append(task)
+            continue
+
+        # Restart
+        previous = [install]
+        size = get_batch_size(config.options.batch, len(ikaaros))
+        group = get_host_group(pyenv)
+        for i in range(0, len(ikaaros), size):
+            previous = [
+                plan.add('restart %s' % x.name,
+                         partial(restart_instance, pyenv, x), previous, group)
+                for x in ikaaros[i:i+size] ]
+            tasks[pyenv.name].extend(previous)
+
+    return plan, limits, tasks
+
+
+
+def deploy(pyenvs, reindex=False, online=False):
+    """Deploys the given Python environments, see make_deploy_plan.  The
+    number of tasks to run at once is given by the --jobs option, by the
+    --jobs-per-host option for the tasks on a same host, by the 'jobs'
+    option of the mirror for the syncs, and by the number of CPUs of the
+    host for the reindexes.  With the --dry-run option, just print the
+    plan.
+
+    Prints a summary with the outcome and the elapsed time of every
+    environment, like module.run_action.
+    """
+    plan, limits, tasks = make_deploy_plan(pyenvs, reindex, online)
+    if config.options.dry_run:
+        plan.print_plan()
+        return
+
+    print '**********************************************************'
+    print ' DEPLOY'
+    print '**********************************************************'
+    failures = plan.run(max(limits.values()), limits)
+
+    # Summary
+    if len(pyenvs) > 1:
+        name = 'deploy'
+        if reindex:
+            name = 'deploy_reindex_online' if online else 'deploy_reindex'
+        failed_tasks = set([ x[0] for x in failures ])
+        failed = set()
+        times = {}
+        for pyenv in pyenvs:
+            if failed_tasks.intersection(tasks[pyenv.name]):
+                failed.add(pyenv.name)
+            done = [ plan.by_name[x] for x in tasks[pyenv.name] ]
+            done = [ x for x in done if x.start is not None ]
+            if done:
+                times[pyenv.name] = (max([ x.end for x in done ])
+                                     - min([ x.start for x in done ]))
+        print_summary(name, pyenvs, failed, times)
+    check_failures(failures)
+
+
+
 # Register
 register_module('ikaaro', ikaaro)
 register_module('pyenv', pyenv)
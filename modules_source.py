@@ -15,15 +15,18 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from hashlib import sha1
+from os import getpid, listdir, makedirs, rename
+from os.path import basename, exists, expanduser
+from shutil import copy, rmtree
 from sys import prefix, executable
-from os.path import expanduser
-
-# Import from itools
-from itools.fs import lfs
+from threading import current_thread
 
 # Import from usine
+from cache import get_value, set_value
 from config import config
 from hosts import local
+from jobs import check_failures, get_lock, run_jobs
 from modules import module, register_module
 
 
@@ -32,6 +35,12 @@ class pysrc(module):
     class_title = u'Manage Python packages'
 
 
+    @classmethod
+    def get_references(cls, options):
+        mirror = options.get('mirror')
+        return [('mirror', mirror)] if mirror else []
+
+
     def get_actions(self):
         if config.options.offline:
             return ['checkout', 'build', 'dist']
@@ -44,76 +53,363 @@ class pysrc(module):
         return super(pysrc, self).get_action(name)
 
 
-    def get_pkgname(self):
-        cwd = self.get_path()
-        local.chdir(cwd)
-        return local.run([executable, 'setup.py', '--fullname']).strip()
+    def get_pkgname(self, version=None):
+        """Returns the full name (name-version) of the package.  Calling
+        setup.py is costly, so the value is cached, keyed by the commit
+        checked out and by the contents of setup.py and setup.conf.
+        """
+        cwd = self.get_worktree(version)
+        key = [self.name, self.get_commit(version)]
+        for name in ['setup.py', 'setup.conf']:
+            path = '%s/%s' % (cwd, name)
+            if exists(path):
+                with open(path) as file:
+                    key.append(sha1(file.read()).hexdigest())
+        key = ' '.join(key)
+
+        pkgname = get_value('pkgname', key)
+        if pkgname is None:
+            command = [executable, 'setup.py', '--fullname']
+            pkgname = local.run(command, cwd=cwd).strip()
+            set_value('pkgname', key, pkgname)
+        return pkgname
+
+
+    def get_version(self, version):
+        if version is None:
+            return config.options.branch
+        return version
 
 
     def get_path(self):
+        """Returns the path to the clone of the repository, its object store
+        is shared by the worktrees of every version.
+        """
         path = '~/.usine/cache/%s' % self.name.replace('/', '-')
         return expanduser(path)
 
 
-    def get_url(self):
+    def get_worktree(self, version=None):
+        """Returns the path to the worktree of the given version (a branch,
+        or a tag if it starts by '@').
+        """
+        version = self.get_version(version)
+        name = self.name.replace('/', '-')
+        path = '~/.usine/worktrees/%s/%s' % (name, version.replace('/', '-'))
+        return expanduser(path)
+
+
+    def get_commit(self, version=None):
+        cwd = self.get_worktree(version)
+        return local.run(['git', 'rev-parse', 'HEAD'], cwd=cwd).strip()
+
+
+    def get_artifact_path(self, commit):
+        """Returns the folder of the artifact store where the source
+        distribution built from the given commit, with the current Python
+        interpreter, is kept.
+        """
+        python = sha1(executable).hexdigest()[:8]
+        name = self.name.replace('/', '-')
+        path = '~/.usine/artifacts/%s/%s-%s' % (name, commit, python)
+        return expanduser(path)
+
+
+    def get_sdist(self, version=None):
+        """Returns the path to the source distribution of the given version,
+        or None if it has not been built yet.
+        """
+        path = self.get_artifact_path(self.get_commit(version))
+        if not exists(path):
+            return None
+        names = [ x for x in listdir(path) if x.endswith('.tar.gz') ]
+        if not names:
+            return None
+        return '%s/%s' % (path, names[0])
+
+
+    def store_sdist(self, version=None):
+        """Copies the source distribution just built to the artifact store.
+        The dist folder may keep the tarballs of previous versions, the one
+        of this version is <pkgname>.tar.gz.
+        """
+        cwd = self.get_worktree(version)
+        dist = '%s/dist' % cwd
+        name = '%s.tar.gz' % self.get_pkgname(version)
+        if not exists('%s/%s' % (dist, name)):
+            raise ValueError, 'the source distribution %s is not in %s' % (
+                name, dist)
+
+        path = self.get_artifact_path(self.get_commit(version))
+        if exists(path):
+            return
+        tmp = get_tmp_path(path)
+        makedirs(tmp)
+        copy('%s/%s' % (dist, name), tmp)
+        store_artifact(tmp, path)
+
+
+    def get_wheel_path(self, commit, python):
+        """Returns the folder of the artifact store where the wheel built
+        from the given commit, for the ABI of the given Python interpreter,
+        is kept.
+        """
+        name = self.name.replace('/', '-')
+        abi = get_abi(python)
+        path = '~/.usine/artifacts/%s/%s-wheel-%s' % (name, commit, abi)
+        return expanduser(path)
+
+
+    def get_wheel(self, version, python):
+        """Returns the path to the wheel of the given version for the given
+        Python interpreter, or None if it has not been built yet.
+        """
+        path = self.get_wheel_path(self.get_commit(version), python)
+        if not exists(path):
+            return None
+        names = [ x for x in listdir(path) if x.endswith('.whl') ]
+        if not names:
+            return None
+        return '%s/%s' % (path, names[0])
+
+
+    def build_wheel(self, version, python):
+        """Builds the wheel of the given version, from its source
+        distribution, with the given (local) Python interpreter, and keeps
+        it in the artifact store.  Skipped if the store has it already.
+        """
+        wheel = self.get_wheel(version, python)
+        if wheel:
+            print '[INFO] %s already built, skipping.' % basename(wheel)
+            return
+
+        sdist = self.get_sdist(version)
+        if sdist is None:
+            raise ValueError, 'the source "%s" is not built' % self.name
+        path = self.get_wheel_path(self.get_commit(version), python)
+        tmp = get_tmp_path(path)
+        makedirs(tmp)
+        try:
+            command = [python, '-m', 'pip', 'wheel', '--quiet', '--no-deps',
+                       '--wheel-dir', tmp, sdist]
+            local.run(command)
+        except EnvironmentError:
+            rmtree(tmp)
+            raise
+        store_artifact(tmp, path)
+
+
+    def get_mirror(self):
         mirror = self.options['mirror']
-        mirror = config.get_section('mirror', mirror)
+        return config.get_section('mirror', mirror)
+
+
+    def get_url(self):
+        mirror = self.get_mirror()
         mirror = mirror.options['url']
         return '%s%s.git' % (mirror, self.name)
 
 
+    def get_sync_option(self, name):
+        """Returns the given option of the pysrc section, defaults to the
+        option of its mirror section.
+        """
+        value = self.options.get(name)
+        if value is None:
+            value = self.get_mirror().options.get(name)
+        return value
+
+
+    def get_repository_lock(self):
+        """The lock to hold while changing the repository (fetch, add a
+        worktree, ...).
+        """
+        return get_lock(('pysrc', self.name))
+
+
+    def get_worktree_lock(self, version=None):
+        """The lock to hold while changing the worktree of the given
+        version (checkout, build).
+        """
+        version = self.get_version(version)
+        return get_lock(('pysrc', self.name, version))
+
+
     def _checkout(self, version):
-        cwd = self.get_path()
-        local.chdir(cwd)
-        on_tag = version.startswith('@')
-        if not on_tag:
-            # Checkout branch
-            try:
-                local.run(['git', 'checkout', version])
-            except EnvironmentError:
-                local.run(['git', 'checkout', '-b', version, 'origin/%s' % version])
-            else:
-                local.run(['git', 'reset', '--hard', 'origin/%s' % version])
+        path = self.get_path()
+        if version.startswith('@'):
+            # Tag
+            ref = version[1:]
+            with self.get_repository_lock():
+                local.run(['git', 'fetch', '--tags'], cwd=path)
         else:
-            # Checkout tag
-            tag = version[1:]
-            local.run(['git', 'fetch', '--tags'])
-            local.run(['git', 'checkout', tag])
-        local.run('git clean -fxdq')
+            # Branch
+            ref = 'origin/%s' % version
+
+        cwd = self.get_worktree(version)
+        if not exists(cwd):
+            # Every worktree has a detached HEAD, so a branch can be checked
+            # out in many of them
+            with self.get_repository_lock():
+                local.run(['git', 'worktree', 'prune'], cwd=path)
+                local.run(['git', 'worktree', 'add', '--detach', cwd, ref],
+                          cwd=path)
+        else:
+            local.run(['git', 'reset', '--hard', ref], cwd=cwd)
+        local.run('git clean -fxdq', cwd=cwd)
 
 
 
     sync_title = u'[private] Synchronize the source from the mirror'
     def action_sync(self):
-        # Case 1: Fetch
+        """Clones or fetches the repository.  These options of the pysrc
+        section, or of its mirror section, apply:
+
+        - reference: the URL prefix of local repositories to borrow the
+          objects from (git alternates), as the 'url' option of the mirror
+        - depth: make a shallow clone with the given depth
+        - filter: make a partial clone with the given filter (e.g. blob:none)
+        """
         folder = self.get_path()
-        if lfs.exists(folder):
-            local.run('git fetch origin', cwd=folder)
-            return
+        depth = self.get_sync_option('depth')
+        with self.get_repository_lock():
+            # Case 1: Fetch
+            if exists(folder):
+                command = ['git', 'fetch', 'origin']
+                if depth:
+                    command.insert(2, '--depth=%s' % depth)
+                local.run(command, cwd=folder)
+                return
+
+            # Case 2: Clone
+            command = ['git', 'clone']
+            reference = self.get_sync_option('reference')
+            if reference:
+                reference = '%s%s.git' % (reference, self.name)
+                command.append('--reference-if-able=%s' % reference)
+            if depth:
+                command.extend(['--depth=%s' % depth, '--no-single-branch'])
+            filter = self.get_sync_option('filter')
+            if filter:
+                command.append('--filter=%s' % filter)
+            command.extend([self.get_url(), folder])
+            local.run(command)
+
+
+    def get_host_key(self):
+        return self.options['mirror']
+
 
-        # Case 2: Clone
-        local.run(['git', 'clone', self.get_url(), folder])
+    @classmethod
+    def run_action(cls, items, name, jobs=1, jobs_per_host=None):
+        if name == 'sync':
+            return sync_sources(items)
+        return super(pysrc, cls).run_action(items, name, jobs, jobs_per_host)
 
 
     checkout_title = u'[private] Checkout the given branch (default: master)'
-    def action_checkout(self):
-        self._checkout(config.options.version)
+    def action_checkout(self, version=None):
+        version = self.get_version(version)
+        with self.get_worktree_lock(version):
+            self._checkout(version)
 
 
     build_title = u'[private] Build'
-    def action_build(self):
-        cwd = self.get_path()
-        local.chdir(cwd)
-        local.run([executable, 'setup.py', '--quiet', 'sdist'])
+    def action_build(self, version=None):
+        cwd = self.get_worktree(version)
+        with self.get_worktree_lock(version):
+            local.run([executable, 'setup.py', '--quiet', 'sdist'], cwd=cwd)
+            self.store_sdist(version)
 
 
     dist_title = u'All of the above'
-    def action_dist(self):
-        actions = ['sync', 'checkout', 'build']
-        for name in actions:
-            action = self.get_action(name)
-            if action:
-                action()
+    def action_dist(self, version=None, sync=True):
+        """Synchronize, checkout the given version (default: the --branch
+        option) and build.  The build is skipped if the artifact store
+        already has the source distribution for the checked out commit.
+        """
+        version = self.get_version(version)
+        with self.get_worktree_lock(version):
+            actions = [('sync', ()), ('checkout', (version,))]
+            if not sync:
+                actions.pop(0)
+            for name, args in actions:
+                action = self.get_action(name)
+                if action:
+                    action(*args)
+
+            sdist = self.get_sdist(version)
+            if sdist:
+                print '[INFO] %s already built, skipping.' % basename(sdist)
+                return
+            self.get_action('build')(version)
+
+
+###########################################################################
+# Artifacts
+###########################################################################
+def get_tmp_path(path):
+    thread = current_thread().ident
+    return '%s.tmp-%s-%s' % (path, getpid(), thread)
+
+
+
+def store_artifact(tmp, path):
+    """Moves the temporary folder to the given path of the artifact store.
+    Artifacts are made in a temporary folder first, so the store never
+    holds a partial artifact.
+    """
+    try:
+        rename(tmp, path)
+    except OSError:
+        # Stored meanwhile by someone else
+        rmtree(tmp)
+
+
+
+# What wheels built by a Python interpreter depend on
+abi_code = (
+    'import sys, sysconfig; '
+    'print(sys.version_info[:2], sys.maxunicode, '
+    'sysconfig.get_config_var("SOABI"), sysconfig.get_platform())')
+
+abis = {}
+
+def get_abi(python):
+    """Returns an identifier of the ABI and platform of the given Python
+    interpreter: the wheels it builds may be installed in environments of
+    the same ABI.
+    """
+    abi = abis.get(python)
+    if abi is None:
+        output = local.run([python, '-c', abi_code])
+        abi = abis[python] = sha1(output).hexdigest()[:8]
+    return abi
+
+
+
+def sync_sources(sources):
+    """Synchronizes the given sources concurrently.  The number of jobs
+    is given by the --jobs option; the number of connections to a same
+    mirror is limited by the 'jobs' option of the mirror section (default:
+    4).
+    """
+    if config.options.offline:
+        return
+
+    print '**********************************************************'
+    print ' SYNC'
+    print '**********************************************************'
+    jobs = []
+    limits = {}
+    for source in sources:
+        mirror = source.get_mirror()
+        limits[mirror.name] = int(mirror.options.get('jobs', 4))
+        jobs.append((source.name, source.get_action('sync'), mirror.name))
+
+    failures = run_jobs(jobs, config.options.jobs, limits)
+    check_failures(failures)
+
 
 
 # Register
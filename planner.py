@@ -0,0 +1,201 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2009-2010 Juan David Ibáñez Palomar <jdavid@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from threading import Condition, Thread
+from time import time
+
+# Import from usine
+from cache import get_value, set_value
+from jobs import run_job
+from tracing import span
+
+
+"""
+This module runs a plan: a graph of tasks (build a package, upload it,
+restart an instance, ...) with explicit dependencies.  A task starts as
+soon as the tasks it depends on are done, so independent work overlaps
+(e.g. a package is uploaded while the next one is still built).
+
+The duration of every task is remembered, keyed by its name, to estimate
+how long the next run will take (see Plan.print_plan).
+"""
+
+
+class Task(object):
+
+    # When the task started and ended, once run
+    start = None
+    end = None
+
+    def __init__(self, name, function, deps, group):
+        self.name = name
+        self.function = function
+        self.deps = deps
+        self.group = group
+
+
+    def get_estimate(self):
+        """Returns how long the task took the last time, or None.
+        """
+        return get_value('durations', self.name)
+
+
+
+class Plan(object):
+
+    def __init__(self):
+        self.tasks = []
+        self.by_name = {}
+
+
+    def add(self, name, function, deps=(), group=None):
+        """Adds a task, after the tasks it depends on.  Returns its name.
+        """
+        if name in self.by_name:
+            raise ValueError, 'the task "%s" is already planned' % name
+        for dep in deps:
+            if dep not in self.by_name:
+                raise ValueError, 'unexpected dependency "%s"' % dep
+        task = Task(name, function, list(deps), group)
+        self.tasks.append(task)
+        self.by_name[name] = task
+        return name
+
+
+    def get_estimates(self):
+        """Returns the estimated duration of every task {name: seconds}
+        (zero if unknown), and of the whole plan: the longest chain of
+        dependencies, as if every task could run at once.
+        """
+        estimates = {}
+        finish = {}
+        for task in self.tasks:
+            estimate = task.get_estimate() or 0.0
+            estimates[task.name] = estimate
+            start = max([ finish[x] for x in task.deps ] or [0.0])
+            finish[task.name] = start + estimate
+        return estimates, max(finish.values() or [0.0])
+
+
+    def print_plan(self):
+        estimates, total = self.get_estimates()
+        print '**********************************************************'
+        print ' PLAN'
+        print '**********************************************************'
+        width = max([ len(x.name) for x in self.tasks ] or [0])
+        for task in self.tasks:
+            estimate = task.get_estimate()
+            estimate = '%7.1f s' % estimate if estimate is not None else \
+                       '      ? s'
+            after = ', '.join(task.deps) or '-'
+            print '%s  %s  after: %s' % (estimate, task.name.ljust(width),
+                                         after)
+        print
+        print 'Estimated: %.1f s (%d tasks, %.1f s in total)' % (
+            total, len(self.tasks), sum(estimates.values()))
+
+
+    def run_task(self, task, failures):
+        task.start = time()
+        n = len(failures)
+        with span(task.name, 'task'):
+            run_job(task.name, task.function, failures)
+        task.end = time()
+        if len(failures) == n:
+            set_value('durations', task.name, task.end - task.start)
+
+
+    def run(self, n=1, limits=None):
+        """Runs the tasks, using at most 'n' threads, and at most as many
+        tasks of a same group as 'limits' tells (see jobs.run_jobs; the
+        tasks with no group are in the group None).  The tasks that depend
+        on a failed task are skipped.  Returns the list
+        of failures [(name, error, details), ...].
+        """
+        failures = []
+        pending = list(self.tasks)
+        done = set()
+        failed = set()
+        running = {}  # group: number of tasks running
+        condition = Condition()
+
+        def get_limit(group):
+            # At least 1, else the tasks of the group would never start
+            if limits is None:
+                return max(n, 1)
+            if type(limits) is int:
+                return max(limits, 1)
+            return max(limits.get(group, n), 1)
+
+        def next_task():
+            # Called with the condition acquired
+            while pending:
+                for task in pending:
+                    deps = set(task.deps)
+                    if deps & failed:
+                        pending.remove(task)
+                        failed.add(task.name)
+                        dep = sorted(deps & failed)[0]
+                        failures.append(
+                            (task.name, None, 'skipped, %s failed' % dep))
+                        condition.notify_all()
+                        break
+                    group = task.group
+                    if not deps <= done:
+                        continue
+                    if running.get(group, 0) < get_limit(group):
+                        pending.remove(task)
+                        running[group] = running.get(group, 0) + 1
+                        return task
+                else:
+                    condition.wait()
+            return None
+
+        def worker():
+            while True:
+                with condition:
+                    task = next_task()
+                if task is None:
+                    return
+                errors = []
+                try:
+                    self.run_task(task, errors)
+                finally:
+                    with condition:
+                        failures.extend(errors)
+                        if errors:
+                            failed.add(task.name)
+                        else:
+                            done.add(task.name)
+                        running[task.group] -= 1
+                        condition.notify_all()
+
+        threads = []
+        for i in range(max(min(n, len(self.tasks)), 1)):
+            thread = Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        # Join with a timeout, so the main thread can be interrupted
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+
+        # Keep the order of the tasks
+        order = [ x.name for x in self.tasks ]
+        failures.sort(key=lambda x: order.index(x[0]))
+        return failures
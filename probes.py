@@ -0,0 +1,212 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2009-2010 Juan David Ibáñez Palomar <jdavid@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from functools import partial
+from httplib import HTTPConnection, HTTPException, HTTPSConnection
+from math import ceil
+import socket
+from threading import Lock
+from time import sleep, time
+from urlparse import urlsplit
+
+# Import from usine
+from jobs import run_jobs
+
+
+"""
+This module checks whether ikaaro instances are alive, by requesting their
+control page (<uri>/;_ctrl): probe and wait_ready for a single instance,
+check to measure the latency of many instances concurrently.
+"""
+
+
+def get_ctrl_path(uri):
+    scheme, netloc, path, query, fragment = urlsplit(uri)
+    return '%s/;_ctrl' % path.rstrip('/')
+
+
+
+def probe(uri, timeout=5):
+    """Returns True if the instance at the given URI answers its control
+    page with 200 within the timeout (seconds).
+    """
+    scheme, netloc, path, query, fragment = urlsplit(uri)
+    if scheme == 'https':
+        connection = HTTPSConnection(netloc, timeout=timeout)
+    else:
+        connection = HTTPConnection(netloc, timeout=timeout)
+    try:
+        connection.request('GET', get_ctrl_path(uri))
+        response = connection.getresponse()
+        response.read()
+        return response.status == 200
+    except (HTTPException, socket.error):
+        return False
+    finally:
+        connection.close()
+
+
+
+def wait_ready(uri, timeout=60, interval=1):
+    """Probes the instance until it is ready.  Returns the seconds it took,
+    or None if it was not ready within the timeout.
+    """
+    t0 = time()
+    while True:
+        remaining = timeout - (time() - t0)
+        if remaining <= 0:
+            return None
+        if probe(uri, min(5, remaining)):
+            return time() - t0
+        sleep(min(interval, max(0, timeout - (time() - t0))))
+
+
+
+###########################################################################
+# Health checks
+###########################################################################
+class ConnectionPool(object):
+    """Keeps the HTTP connections open (keep-alive) to reuse them for the
+    next requests to the same host.
+    """
+
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+        self.free = {}  # (scheme, netloc): [connection, ...]
+        self.lock = Lock()
+
+
+    def get_connection(self, key):
+        """Returns a free connection to the given (scheme, netloc), and
+        whether it has been used before.
+        """
+        with self.lock:
+            connections = self.free.get(key)
+            if connections:
+                return connections.pop(), True
+
+        scheme, netloc = key
+        if scheme == 'https':
+            return HTTPSConnection(netloc, timeout=self.timeout), False
+        return HTTPConnection(netloc, timeout=self.timeout), False
+
+
+    def release(self, key, connection):
+        with self.lock:
+            self.free.setdefault(key, []).append(connection)
+
+
+    def get(self, uri, path):
+        """Requests the given path of the server of the given URI.  Returns
+        the status of the response.  Raises socket.error or HTTPException
+        if the server does not answer in time.
+        """
+        scheme, netloc, x, x, x = urlsplit(uri)
+        key = (scheme, netloc)
+        while True:
+            connection, reused = self.get_connection(key)
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+            except (HTTPException, socket.error):
+                connection.close()
+                # The server may have closed a kept-alive connection, then
+                # try again with a new one
+                if reused:
+                    continue
+                raise
+            break
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(key, connection)
+        return response.status
+
+
+    def close(self):
+        with self.lock:
+            for connections in self.free.values():
+                for connection in connections:
+                    connection.close()
+            self.free.clear()
+
+
+
+def get_percentile(values, percent):
+    """Returns the given percentile of the values (nearest rank), or None if
+    there are no values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+
+def check(uris, samples=5, timeout=5, jobs=10):
+    """Probes the control page of every URI, 'samples' times, at most
+    'jobs' URIs concurrently.  Returns a report {uri: {...}} with the number
+    of successful and failed probes, and the latency percentiles (in
+    milliseconds) of the successful ones.
+
+    If probing an URI fails otherwise (e.g. the URI is malformed), every
+    probe counts as failed, and the report has the error.
+    """
+    pool = ConnectionPool(timeout)
+    report = {}
+
+    def probe_uri(uri):
+        latencies = []
+        errors = 0
+        path = get_ctrl_path(uri)
+        for i in range(samples):
+            t0 = time()
+            try:
+                status = pool.get(uri, path)
+            except (HTTPException, socket.error):
+                status = None
+            if status == 200:
+                latencies.append((time() - t0) * 1000)
+            else:
+                errors += 1
+        report[uri] = {
+            'ok': len(latencies),
+            'errors': errors,
+            'p50': get_percentile(latencies, 50),
+            'p90': get_percentile(latencies, 90),
+            'p99': get_percentile(latencies, 99),
+            'max': max(latencies) if latencies else None}
+
+    try:
+        failures = run_jobs([ (uri, partial(probe_uri, uri)) for uri in uris ],
+                            jobs)
+    finally:
+        pool.close()
+
+    for uri, error, details in failures:
+        report[uri] = {
+            'ok': 0,
+            'errors': samples,
+            'error': str(error) or type(error).__name__,
+            'p50': None,
+            'p90': None,
+            'p99': None,
+            'max': None}
+    return report
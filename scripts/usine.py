@@ -16,11 +16,59 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from marshal import dumps, loads
 from optparse import OptionParser, IndentedHelpFormatter
-from sys import exit
+from os.path import expanduser, getmtime
+from sys import argv, exit, modules as sys_modules, stderr, version_info
+from time import time
+t0 = time()
+
+
+###########################################################################
+# Shell completion (see contrib/usine_completion)
+###########################################################################
+# The words that may follow 'usine.py', 'usine.py <module>' and 'usine.py
+# <module> <item>' are kept in an index, made again when the configuration
+# or usine change.  It is read before importing usine, so completing costs
+# little more than reading a file.
+complete_path = expanduser('~/.usine/var/complete.index')
+complete_version = (1, tuple(version_info[:2]))
+
+
+def complete(words):
+    """Prints the words that may follow the given ones.  Returns False if
+    the index is missing or out of date.
+    """
+    try:
+        with open(complete_path, 'rb') as file:
+            index = loads(file.read())
+        if index['version'] != complete_version:
+            return False
+        for path, mtime in index['sources'].iteritems():
+            if getmtime(path) != mtime:
+                return False
+    except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+        return False
+
+    for word in index['words'].get(tuple(words[:2]), []):
+        print word
+    return True
+
+
+if __name__ == '__main__' and argv[1:2] == ['--complete']:
+    if complete(argv[2:]):
+        exit(0)
 
 # Import from usine
 from libusine import config, modules, remote_hosts
+from libusine.agent import serve
+from libusine.config import write_index
+from libusine.jobs import JobsError
+from libusine import tracing
+t1 = time()
+
+# Slow to load, see --startup-time
+heavy_modules = ['paramiko', 'itools.fs', 'itools.database', 'httplib']
 
 
 
@@ -39,9 +87,37 @@ class HelpFormatter(IndentedHelpFormatter):
 
 
 
+def make_complete_index():
+    """Writes the index read by complete.
+    """
+    words = {}
+    words[()] = [ x for x in sorted(modules) if modules[x].class_title ]
+    for name in words[()]:
+        items = config.get_sections_by_type(name)
+        words[(name,)] = [ x.name for x in items ] + ['all']
+        for item in items:
+            words[(name, item.name)] = list(item.get_actions())
+        if items:
+            words[(name, 'all')] = [ x for x in items[0].get_actions()
+                                     if all(x in item.get_actions()
+                                            for item in items) ]
+
+    # Made again when the configuration, or the code of a module, changes
+    sources = dict(config.index['sources'])
+    for module in modules.values():
+        path = sys_modules[module.__module__].__file__
+        sources[path] = getmtime(path)
+    index = {'version': complete_version, 'sources': sources, 'words': words}
+    write_index(complete_path, index)
+    return index
+
+
+
 if __name__ == '__main__':
     # Command line
-    usage = 'usine.py [options] <module> <item> <action>...'
+    usage = 'usine.py [options] <module> <item> <action>...\n\n' \
+        '<item> may also select many items: a glob pattern, "all", ' \
+        '"tag:<tag>",\nor a comma separated list of them.'
     parser = OptionParser(usage, description='foo', formatter=HelpFormatter())
     parser.add_option('--offline', action='store_true',
         help='In this mode the source code will not be synchronized from the '
@@ -49,14 +125,72 @@ if __name__ == '__main__':
     parser.add_option('-b', '--branch', default='master',
         help='The branch to use (default: master), this option only applies '
              ' to some actions.')
+    parser.add_option('-j', '--jobs', type='int', default=1,
+        help='The number of jobs to run concurrently (default: 1), this '
+             'option only applies to some actions.')
+    parser.add_option('--jobs-per-host', type='int',
+        help='When many items are selected, the number of them to run '
+             'concurrently on a same host (default: same as --jobs).')
+    parser.add_option('--batch', default='1',
+        help='The number, or percentage (e.g. 25%), of ikaaro instances to '
+             'restart at once (default: 1).')
+    parser.add_option('--timeout', type='int', default=60,
+        help='The seconds to wait for an ikaaro instance to be ready after '
+             'starting it (default: 60).')
+    parser.add_option('--samples', type='int', default=5,
+        help='The number of times to probe every ikaaro instance when '
+             'testing them (default: 5).')
+    parser.add_option('--json',
+        help='When testing ikaaro instances, also write the report as JSON '
+             'to the given file ("-" for the standard output).')
+    parser.add_option('--agent', action='store_true',
+        help='Start the agent, which keeps the SSH connections open for the '
+             'next invocations, until interrupted or idle for 30 minutes.')
+    parser.add_option('--complete', action='store_true',
+        help='Print the words that may follow the given module and item, '
+             'for the shell completion.')
+    parser.add_option('--dry-run', action='store_true',
+        help='With the deploy and deploy_reindex actions, print the tasks '
+             'that would run, with their estimated duration, and stop.')
+    parser.add_option('--trace',
+        help='Record how long every action, package and host command takes, '
+             'and write it as JSON lines to the given file.')
+    parser.add_option('--chrome-trace',
+        help='Same as --trace, in the trace event format of Chrome (see '
+             'chrome://tracing).')
+    parser.add_option('--profile',
+        help='Profile the actions (in the main thread) with cProfile, and '
+             'write the statistics to the given file (see pstats).')
+    parser.add_option('--startup-time', action='store_true',
+        help='Print to the standard error the time spent importing usine '
+             'and loading the configuration, and the slow modules loaded.')
     options, args = parser.parse_args()
 
+    # The agent
+    if options.agent:
+        serve()
+        exit(0)
+
     # Configuration
     error = config.load()
     if error:
         print error
         exit(1)
     config.options = options
+    if options.startup_time:
+        t2 = time()
+        loaded = [ x for x in heavy_modules if x in sys_modules ]
+        print >> stderr, 'Startup: %.1f ms (import %.1f ms, config %.1f ms)' \
+                % ((t2 - t0) * 1000, (t1 - t0) * 1000, (t2 - t1) * 1000)
+        print >> stderr, 'Slow modules loaded: %s' % (', '.join(loaded)
+                                                      or 'none')
+
+    # Shell completion, the index is out of date (see complete)
+    if options.complete:
+        index = make_complete_index()
+        for word in index['words'].get(tuple(args[:2]), []):
+            print word
+        exit(0)
 
     # Case 0: Nothing, print help
     if not args:
@@ -90,18 +224,23 @@ if __name__ == '__main__':
         print
         print 'Items:'
         print
-        for item in config.get_sections_by_type(module_name):
-            print '  %s' % item.name
+        for name in config.get_names_by_type(module_name):
+            print '  %s' % name
+        print '  all'
         exit(0)
 
-    # Get the item
+    # Get the item(s): a name, or a selector (see select_sections)
     item_name, args = args[0], args[1:]
-    item = config.get_section(module_name, item_name)
-    if not item:
+    items = config.select_sections(module_name, item_name)
+    if not items:
         print 'Error: "%s" module got unexpected "%s" item' \
                 % (module_name, item_name)
         exit(1)
 
+    # The actions available for every item
+    actions = [ x for x in items[0].get_actions()
+                if all(x in item.get_actions() for item in items) ]
+
     # Case 2: The module and the item, print help
     if not args:
         usage = 'usine.py [options] %s %s <action>...'
@@ -109,23 +248,42 @@ if __name__ == '__main__':
         print
         print 'Actions:'
         print
-        for action in item.get_actions():
+        for action in actions:
             title = getattr(module, '%s_title' % action)
             action = action + " " * (15 - len(action))
             print '  %s: %s' % (action, title)
         exit(0)
 
     # Case 3: The module, the item and the action(s)
-    for action_name in args:
-        # Get the action
-        if action_name not in item.get_actions():
-            print 'Error: "%s" module got unexpected "%s" action' \
-                    % (module_name, action_name)
-            exit(1)
-
-        # Call
-        action = item.get_action(action_name)
-        action()
+    tracing.enabled = bool(options.trace or options.chrome_trace)
+    if options.profile:
+        from cProfile import Profile
+        profile = Profile()
+        profile.enable()
+    try:
+        for action_name in args:
+            # Get the action
+            if action_name not in actions:
+                print 'Error: "%s" module got unexpected "%s" action' \
+                        % (module_name, action_name)
+                exit(1)
+
+            # Call
+            try:
+                module.run_action(items, action_name, options.jobs,
+                                  options.jobs_per_host)
+            except (JobsError, EnvironmentError), error:
+                print 'Error: %s' % error
+                exit(1)
+    finally:
+        # Write the trace and the profile, also if an action failed
+        if options.profile:
+            profile.disable()
+            profile.dump_stats(options.profile)
+        if options.trace:
+            tracing.export_json_lines(options.trace)
+        if options.chrome_trace:
+            tracing.export_chrome(options.chrome_trace)
 
     # Close connections
     for host in remote_hosts.values():
@@ -0,0 +1,180 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2009-2010 Juan David Ibáñez Palomar <jdavid@itaapy.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from contextlib import contextmanager
+from itertools import count
+from json import dumps
+from os import getpid
+from threading import Lock, current_thread, local
+from time import time
+
+
+"""
+This module records spans: what every action, package and host command
+did, when, and for how long, with attributes such as the bytes transferred
+or the exit status.  Spans started while another is open, in the same
+thread, are its children.
+
+Tracing is off unless enabled (see the --trace and --chrome-trace options
+of usine.py).  The spans are exported as JSON lines, or in the trace event
+format of Chrome (chrome://tracing, Perfetto).
+"""
+
+
+enabled = False
+
+# The finished spans
+spans = []
+spans_lock = Lock()
+
+# The open spans of every thread
+stacks = local()
+
+ids = count(1)
+
+
+
+class Span(object):
+
+    def __init__(self, name, category, args):
+        self.id = None
+        self.parent = None
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+        self.end = None
+        thread = current_thread()
+        self.thread = thread.ident
+        self.thread_name = thread.name
+
+
+    def set(self, **kw):
+        self.args.update(kw)
+
+
+    def get_duration(self):
+        return self.end - self.start
+
+
+
+def get_stack():
+    stack = getattr(stacks, 'stack', None)
+    if stack is None:
+        stack = stacks.stack = []
+    return stack
+
+
+
+@contextmanager
+def span(name, category, **args):
+    """Records the time spent in the 'with' block.  The span is given to
+    the block, to set more attributes (see Span.set).  If the block raises
+    an exception, it is recorded as the 'error' attribute.
+    """
+    span = Span(name, category, args)
+    if not enabled:
+        yield span
+        return
+
+    stack = get_stack()
+    span.id = ids.next()
+    span.parent = stack[-1].id if stack else None
+    span.start = time()
+    stack.append(span)
+    try:
+        yield span
+    except Exception, error:
+        span.args['error'] = str(error) or type(error).__name__
+        raise
+    finally:
+        span.end = time()
+        stack.pop()
+        with spans_lock:
+            spans.append(span)
+
+
+
+def add_span(name, category, start, end, **args):
+    """Records a span measured elsewhere (e.g. by a remote script), as a
+    child of the current span.
+    """
+    if not enabled:
+        return
+
+    stack = get_stack()
+    span = Span(name, category, args)
+    span.id = ids.next()
+    span.parent = stack[-1].id if stack else None
+    span.start = start
+    span.end = end
+    with spans_lock:
+        spans.append(span)
+
+
+
+###########################################################################
+# Export
+###########################################################################
+def get_spans():
+    with spans_lock:
+        return sorted(spans, key=lambda x: x.start)
+
+
+
+def export_json_lines(path):
+    """Writes one JSON object per span, times in seconds since the epoch.
+    """
+    with open(path, 'w') as file:
+        for span in get_spans():
+            data = {
+                'id': span.id,
+                'parent': span.parent,
+                'name': span.name,
+                'category': span.category,
+                'start': span.start,
+                'duration': span.get_duration(),
+                'thread': span.thread_name,
+                'args': span.args}
+            file.write(dumps(data) + '\n')
+
+
+
+def export_chrome(path):
+    """Writes the spans in the trace event format of Chrome, as complete
+    events (times in microseconds).
+    """
+    pid = getpid()
+    events = []
+    threads = {}
+    for span in get_spans():
+        threads[span.thread] = span.thread_name
+        events.append({
+            'name': span.name,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': int(span.start * 1000000),
+            'dur': int(span.get_duration() * 1000000),
+            'pid': pid,
+            'tid': span.thread,
+            'args': span.args})
+    for tid, name in threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': tid, 'args': {'name': name}})
+
+    with open(path, 'w') as file:
+        file.write(dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))